@@ -0,0 +1,174 @@
+'''
+Australian National University Data Commons
+Copyright (C) 2013  The Australian National University
+
+This file is part of Australian National University Data Commons.
+
+Australian National University Data Commons is free software: you
+can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Rahul Khanna <rahul.khanna@anu.edu.au>
+
+Measures the memory used while planning and uploading increasing numbers of files, with the lists of files and their
+statuses kept in memory and with --spool-dir, to check that memory use doesn't grow with the number of files when
+spooling. The checksum cache and checkpoint are enabled, as in a long running upload. Files are uploaded to a local HTTP
+server that discards them. The server runs in a separate process so its memory isn't counted.
+
+	python3 memory_benchmark.py --files 5000 10000
+'''
+
+import argparse
+import contextlib
+import http.server
+import multiprocessing
+import os
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pydcclient"))
+
+import dcuploader
+from anudclib import AnudcClient
+from anudclib import AnudcServerConfig
+from spool import UploadCheckpoint
+
+
+VERSION = "0.1-20261019"
+
+FILES_PER_DIR = 1000
+UPLOAD_WORKERS = 4
+
+
+class DiscardingRequestHandler(http.server.BaseHTTPRequestHandler):
+	'''Reports every file as missing and accepts and discards every upload.
+	'''
+	protocol_version = "HTTP/1.1"
+	
+	def log_message(self, format, *args):
+		pass
+	
+	def do_HEAD(self):
+		self.send_response(404)
+		self.send_header("Content-Length", "0")
+		self.end_headers()
+	
+	def do_POST(self):
+		if self.headers.get("Transfer-Encoding") == "chunked":
+			while True:
+				chunk_size = int(self.rfile.readline().strip(), 16)
+				self.rfile.read(chunk_size)
+				self.rfile.readline()
+				if chunk_size == 0:
+					break
+		else:
+			self.rfile.read(int(self.headers.get("Content-Length", 0)))
+		self.send_response(201)
+		self.send_header("Content-Length", "2")
+		self.end_headers()
+		self.wfile.write(b"OK")
+
+
+def serve(ports):
+	server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), DiscardingRequestHandler)
+	ports.put(server.server_address[1])
+	server.serve_forever()
+
+
+def create_files(data_dir, n_files):
+	for i in range(n_files):
+		dirpath = os.path.join(data_dir, "d" + str(i // FILES_PER_DIR))
+		if i % FILES_PER_DIR == 0:
+			os.mkdir(dirpath)
+		with open(os.path.join(dirpath, "f" + str(i)), "w") as fp:
+			fp.write("x")
+
+
+def write_config(work_dir, port):
+	config_filename = os.path.join(work_dir, "anudc.conf")
+	with open(config_filename, "w") as fp:
+		fp.write("[datacommons]\n")
+		fp.write("host = 127.0.0.1:" + str(port) + "\n")
+		fp.write("proto = http\n")
+		fp.write("uploadfile_url = /upload/\n")
+		fp.write("username = benchmark\n")
+		fp.write("password = benchmark\n")
+		fp.write("inter_fileupload_delay = 0\n")
+		fp.write("checksum_cache = " + os.path.join(work_dir, "checksums.txt") + "\n")
+	return config_filename
+
+
+def measure_upload(config_filename, data_dir, work_dir, spool_dir):
+	'''Plans and uploads the files in data_dir, and returns the number of files uploaded successfully with the peak
+	memory allocated and the memory still allocated once all files are uploaded, in bytes.
+	'''
+	tracemalloc.start()
+	anudc = AnudcClient(AnudcServerConfig(config_filename), max_workers=UPLOAD_WORKERS, sequential=False, spool_dir=spool_dir)
+	checkpoint = UploadCheckpoint(os.path.join(work_dir, "checkpoint.txt"), anudc.get_file_scanner().get_stat_cache().stat, spool_dir)
+	files_to_upload, file_status = dcuploader.create_upload_containers(spool_dir)
+	try:
+		with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+			pid, files_to_upload = dcuploader.plan_upload(anudc, pid="benchmark:1", files=[data_dir], files_to_upload=files_to_upload)
+			anudc.upload_files(pid, files_to_upload, file_status, checkpoint=checkpoint)
+		n_uploaded = sum(1 for local_filepath, status in file_status.items() if status == 1)
+		current, peak = tracemalloc.get_traced_memory()
+	finally:
+		with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+			dcuploader.close_upload_containers(files_to_upload, file_status)
+		checkpoint.close()
+		anudc.close()
+		tracemalloc.stop()
+	return n_uploaded, peak, current
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark memory use of uploads with and without a spool directory.")
+	parser.add_argument("--files", type=int, nargs="+", default=[5000, 10000], help="Numbers of files to upload.")
+	args = parser.parse_args()
+	
+	context = multiprocessing.get_context("spawn")
+	ports = context.Queue()
+	server_process = context.Process(target=serve, args=(ports,), daemon=True)
+	server_process.start()
+	try:
+		port = ports.get(timeout=30)
+		print("{:<10} {:>9} {:>9} {:>11} {:>11}".format("", "Files", "Uploaded", "Peak MB", "Retained MB"))
+		results = {}
+		for n_files in sorted(args.files):
+			with tempfile.TemporaryDirectory(prefix="memory-benchmark-") as root:
+				data_dir = os.path.join(root, "data")
+				os.mkdir(data_dir)
+				create_files(data_dir, n_files)
+				for mode in ("in memory", "spooled"):
+					work_dir = os.path.join(root, mode.replace(" ", "-"))
+					os.mkdir(work_dir)
+					config_filename = write_config(work_dir, port)
+					spool_dir = work_dir if mode == "spooled" else None
+					n_uploaded, peak, current = measure_upload(config_filename, data_dir, work_dir, spool_dir)
+					results[(mode, n_files)] = peak
+					print("{:<10} {:>9,} {:>9,} {:>11.1f} {:>11.1f}".format(mode, n_files, n_uploaded, peak / 1e6, current / 1e6))
+		
+		if len(args.files) > 1:
+			print()
+			smallest = min(args.files)
+			largest = max(args.files)
+			for mode in ("in memory", "spooled"):
+				growth = (results[(mode, largest)] - results[(mode, smallest)]) / (largest - smallest)
+				print("{}: peak grows by {:,.0f} bytes per file".format(mode, growth))
+	finally:
+		server_process.terminate()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,250 @@
+'''
+Australian National University Data Commons
+Copyright (C) 2013  The Australian National University
+
+This file is part of Australian National University Data Commons.
+
+Australian National University Data Commons is free software: you
+can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Rahul Khanna <rahul.khanna@anu.edu.au>
+
+Benchmarks reading and updating a large collection parameter file, as done when uploading with -m. Compares the
+configparser based reader used before with MetadataFile, both when a file is opened for the first time and when it's
+opened again unchanged. Before timing, checks that both read the same values.
+
+	python3 metadata_benchmark.py --keys 200 --files 50000
+
+To only generate a parameter file, for example to time dcuploader.py with it:
+
+	python3 metadata_benchmark.py --keys 200 --files 50000 --write collection.txt
+'''
+
+import argparse
+import configparser
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pydcclient"))
+
+from anudclib import MetadataFile
+
+
+VERSION = "0.1-20261019"
+
+
+class ConfigParserMetadataFile:
+	'''Reads and updates a collection parameter file with configparser, as MetadataFile did before it parsed files itself.
+	'''
+	def __init__(self, filename, delimiter="||"):
+		self.__filename = filename
+		self.__delimiter = delimiter
+		self.__config_parser = configparser.ConfigParser()
+		self.__config_parser.optionxform = str
+		with open(filename, "r", encoding="utf-8") as fp:
+			self.__config_parser.read_file(fp)
+	
+	def read_metadata_list(self):
+		metadata = []
+		for key, value in self.__config_parser.items("metadata"):
+			for val in value.split(sep=self.__delimiter):
+				metadata.append((key, val))
+		return metadata
+	
+	def read_upload_files_list(self):
+		try:
+			return self.__config_parser.items("files")
+		except configparser.NoSectionError:
+			return None
+	
+	def read_relations(self):
+		try:
+			relations = self.__config_parser.items("relations")
+		except configparser.NoSectionError:
+			return None
+		return [(key, val) for key, value in relations for val in value.split(sep=self.__delimiter)]
+	
+	def read_pid(self):
+		try:
+			return self.__config_parser.get("pid", "pid")
+		except (configparser.NoSectionError, configparser.NoOptionError):
+			return None
+	
+	def read_template(self):
+		try:
+			return self.__config_parser.get("template", "template")
+		except (configparser.NoSectionError, configparser.NoOptionError):
+			return None
+	
+	def write_pid(self, pid):
+		if not self.__config_parser.has_section("pid"):
+			self.__config_parser.add_section("pid")
+		self.__config_parser.set("pid", "pid", pid)
+		with open(self.__filename, "w", encoding="utf-8") as fp:
+			self.__config_parser.write(fp)
+
+
+# Parameter file using the parts of configparser's syntax that the generated file doesn't.
+EDGE_CASES = '''; Comment before the first section
+[DEFAULT]
+owner = Australian National University
+
+[template]
+template : tmplt:1
+
+[metadata]
+name = 100%% of the data from %(owner)s
+description = A description that continues
+
+	after a blank line
+	# and includes a line starting with #
+  indented : key = value
+keywords = one||two||three
+    [not a section]
+
+[relations]
+isPartOf = test:1||test:2
+
+[DEFAULT]
+contact = %(owner)s
+
+[files]
+data/file1.dat = /data/file1.dat
+data/file 2.dat=/data/file 2.dat
+'''
+
+
+def write_metadata_file(filename, n_keys, n_files, n_relations=10):
+	'''Writes a collection parameter file with n_keys metadata keys, some with several values, n_relations relations and
+	n_files entries in [files].
+	'''
+	with open(filename, "w", encoding="utf-8") as fp:
+		fp.write("# Generated by metadata_benchmark.py\n")
+		fp.write("[template]\ntemplate = tmplt:1\n\n")
+		fp.write("[metadata]\n")
+		fp.write("name = Benchmark collection\n")
+		for i in range(n_keys):
+			if i % 10 == 0:
+				fp.write("keyword" + str(i) + " = first value||second value||third value\n")
+			elif i % 25 == 0:
+				fp.write("description" + str(i) + " = A value that continues\n\ton a second line\n")
+			else:
+				fp.write("field" + str(i) + " = value " + str(i) + "\n")
+		fp.write("\n[relations]\n")
+		for i in range(n_relations):
+			fp.write("isPartOf" + str(i) + " = test:" + str(i) + "\n")
+		fp.write("\n[files]\n")
+		for i in range(n_files):
+			fp.write("dir" + str(i // 1000) + "/file " + str(i) + ".dat = /data/dir" + str(i // 1000) + "/file " + str(i) + ".dat\n")
+
+
+def read_all(metadata_file_class, filename):
+	'''Opens a parameter file and reads it the way dcuploader does when uploading with -m.
+	'''
+	metadata_file = metadata_file_class(filename)
+	metadata_file.read_pid()
+	metadata_file.read_metadata_list()
+	metadata_file.read_relations()
+	return len(metadata_file.read_upload_files_list())
+
+
+def read_results(metadata_file_class, filename):
+	'''Returns what dcuploader reads from a parameter file, or Exception if reading it raised one.
+	'''
+	try:
+		metadata_file = metadata_file_class(filename)
+		return (metadata_file.read_pid(), metadata_file.read_template(), metadata_file.read_metadata_list(), metadata_file.read_relations(), metadata_file.read_upload_files_list())
+	except Exception:
+		return Exception
+
+
+def check_same_results(directory, source):
+	'''Checks that MetadataFile reads the same values as configparser from the generated file and from a file with edge
+	cases, and that both reject a % that isn't followed by % or (. Returns the number of files checked.
+	'''
+	files = [("generated", source)]
+	for name, text in (("edge-cases", EDGE_CASES), ("lone-percent", "[metadata]\nname = 100%\n")):
+		filename = os.path.join(directory, name + ".txt")
+		with open(filename, "w", encoding="utf-8") as fp:
+			fp.write(text)
+		files.append((name, filename))
+	
+	for name, filename in files:
+		expected = read_results(ConfigParserMetadataFile, filename)
+		actual = read_results(MetadataFile, filename)
+		if actual != expected:
+			raise Exception("MetadataFile and configparser read " + name + " file differently:\n" + str(actual) + "\n" + str(expected))
+	if expected is not Exception:
+		raise Exception("A lone % wasn't rejected")
+	return len(files)
+
+
+def time_best(run, repeat):
+	'''Returns the shortest time taken by run, in seconds, over repeat runs. Each run is passed its index.
+	'''
+	best = None
+	for i in range(repeat):
+		start = time.perf_counter()
+		run(i)
+		elapsed = time.perf_counter() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark reading and updating collection parameter files.")
+	parser.add_argument("--keys", type=int, default=200, help="Number of keys in [metadata].")
+	parser.add_argument("--files", type=int, default=50000, help="Number of entries in [files].")
+	parser.add_argument("--repeat", type=int, default=5, help="Number of times each run is repeated. The fastest is reported.")
+	parser.add_argument("--write", metavar="FILENAME", help="Only write a parameter file to FILENAME.")
+	args = parser.parse_args()
+	
+	if args.write is not None:
+		write_metadata_file(args.write, args.keys, args.files)
+		return
+	
+	with tempfile.TemporaryDirectory(prefix="metadata-benchmark-") as directory:
+		source = os.path.join(directory, "collection.txt")
+		write_metadata_file(source, args.keys, args.files)
+		print("{:,} metadata keys, {:,} files, {:,} bytes".format(args.keys, args.files, os.path.getsize(source)))
+		print("MetadataFile and configparser read the same values from {} files".format(check_same_results(directory, source)))
+		print()
+		
+		# MetadataFile caches parsed files by path, so every run that should parse the file opens a new copy of it.
+		copies = {}
+		def copy_before(name, run):
+			for i in range(args.repeat):
+				copies[(name, i)] = os.path.join(directory, name + str(i) + ".txt")
+				shutil.copyfile(source, copies[(name, i)])
+			return lambda i: run(copies[(name, i)])
+		
+		runs = [
+			("configparser, read", copy_before("configparser-read", lambda filename: read_all(ConfigParserMetadataFile, filename))),
+			("MetadataFile, read", copy_before("metadatafile-read", lambda filename: read_all(MetadataFile, filename))),
+			("MetadataFile, read again", lambda i: read_all(MetadataFile, copies[("metadatafile-read", 0)])),
+			("configparser, write PID", copy_before("configparser-write", lambda filename: ConfigParserMetadataFile(filename).write_pid("test:1"))),
+			("MetadataFile, write PID", copy_before("metadatafile-write", lambda filename: MetadataFile(filename).write_pid("test:1"))),
+		]
+		
+		print("{:<26} {:>10}".format("", "ms"))
+		for name, run in runs:
+			print("{:<26} {:>10.2f}".format(name, time_best(run, args.repeat) * 1000))
+
+
+if __name__ == "__main__":
+	main()
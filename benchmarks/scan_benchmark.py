@@ -0,0 +1,213 @@
+'''
+Australian National University Data Commons
+Copyright (C) 2013  The Australian National University
+
+This file is part of Australian National University Data Commons.
+
+Australian National University Data Commons is free software: you
+can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Rahul Khanna <rahul.khanna@anu.edu.au>
+
+Benchmarks listing a directory tree and the stats made while uploading it, on a simulated high latency filesystem such as
+NFS or Lustre where every stat and directory read is a round trip to a server. Compares the os.walk based listing and
+per file os.path calls used before FileScanner with FileScanner and its StatCache.
+
+	python3 scan_benchmark.py --latency-ms 2 --depth 3 --fanout 6 --files-per-dir 10
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pydcclient"))
+
+from scan import FileScanner
+from scan import StatCache
+
+
+VERSION = "0.1-20261019"
+
+
+class SlowFilesystem:
+	'''Adds a delay to every os.stat, os.scandir and DirEntry.stat call while installed, and counts them.
+	'''
+	def __init__(self, latency_sec):
+		self.__latency_sec = latency_sec
+		self.__real_stat = os.stat
+		self.__real_scandir = os.scandir
+		self.__calls = 0
+		self.__lock = threading.Lock()
+	
+	def get_calls(self):
+		return self.__calls
+	
+	def install(self):
+		os.stat = self.__stat
+		os.scandir = self.__scandir
+	
+	def uninstall(self):
+		os.stat = self.__real_stat
+		os.scandir = self.__real_scandir
+	
+	def delay(self):
+		with self.__lock:
+			self.__calls += 1
+		time.sleep(self.__latency_sec)
+	
+	def __stat(self, path, *args, **kwargs):
+		self.delay()
+		return self.__real_stat(path, *args, **kwargs)
+	
+	def __scandir(self, path="."):
+		self.delay()
+		return SlowScandir(self, self.__real_scandir(path))
+
+
+class SlowScandir:
+	def __init__(self, filesystem, entries):
+		self.__filesystem = filesystem
+		self.__entries = entries
+	
+	def __iter__(self):
+		return self
+	
+	def __next__(self):
+		return SlowDirEntry(self.__filesystem, next(self.__entries))
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.__entries.close()
+
+
+class SlowDirEntry:
+	'''Wraps a DirEntry. is_dir and is_symlink use the file type returned with the directory listing, so only stat is
+	delayed.
+	'''
+	def __init__(self, filesystem, entry):
+		self.__filesystem = filesystem
+		self.__entry = entry
+		self.name = entry.name
+		self.path = entry.path
+	
+	def is_dir(self, follow_symlinks=True):
+		return self.__entry.is_dir(follow_symlinks=follow_symlinks)
+	
+	def is_symlink(self):
+		return self.__entry.is_symlink()
+	
+	def stat(self, follow_symlinks=True):
+		self.__filesystem.delay()
+		return self.__entry.stat(follow_symlinks=follow_symlinks)
+
+
+def create_tree(root, depth, fanout, files_per_dir):
+	'''Creates a tree of directories fanout wide and depth deep, with files_per_dir files in each of the deepest
+	directories. Returns the number of directories and files created.
+	'''
+	n_dirs = 0
+	n_files = 0
+	dirs = [root]
+	for level in range(depth):
+		subdirs = []
+		for dirpath in dirs:
+			for i in range(fanout):
+				subdir = os.path.join(dirpath, "d" + str(i))
+				os.mkdir(subdir)
+				subdirs.append(subdir)
+		n_dirs += len(subdirs)
+		dirs = subdirs
+	for dirpath in dirs:
+		for i in range(files_per_dir):
+			with open(os.path.join(dirpath, "f" + str(i)), "w") as fp:
+				fp.write("x")
+			n_files += 1
+	return n_dirs, n_files
+
+
+def run_os_walk(root):
+	'''Lists and stats files as the uploader did before FileScanner: os.walk, isfile and isdir on the root path for every
+	file found, then isfile, getsize and a stat each for the checkpoint check and update as each file is uploaded.
+	'''
+	filepaths = []
+	for dirpath, dirnames, filenames in os.walk(root):
+		dirnames[:] = [dirname for dirname in dirnames if dirname[0] != "."]
+		for filename in filenames:
+			if filename[0] != ".":
+				os.path.isfile(root)
+				os.path.isdir(root)
+				filepaths.append(os.path.join(dirpath, filename))
+	for filepath in filepaths:
+		os.path.isfile(filepath)
+		os.path.getsize(filepath)
+		os.stat(filepath)
+		os.stat(filepath)
+	return len(filepaths)
+
+
+def run_scanner(root, workers):
+	'''Lists and stats files as the uploader does now, with the same per file checks as run_os_walk made through the stat
+	cache.
+	'''
+	stat_cache = StatCache()
+	scanner = FileScanner(stat_cache, workers)
+	filepaths = []
+	if stat_cache.isdir(root):
+		for filepath in scanner.walk(root):
+			filepaths.append(filepath)
+	for filepath in filepaths:
+		stat_cache.isfile(filepath)
+		stat_cache.getsize(filepath)
+		stat_cache.stat(filepath)
+		stat_cache.stat(filepath)
+	return len(filepaths)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark directory listing on a simulated high latency filesystem.")
+	parser.add_argument("--latency-ms", type=float, default=2, help="Delay added to every stat and directory read.")
+	parser.add_argument("--depth", type=int, default=3, help="Depth of the directory tree.")
+	parser.add_argument("--fanout", type=int, default=6, help="Number of subdirectories in each directory.")
+	parser.add_argument("--files-per-dir", type=int, default=10, help="Number of files in each of the deepest directories.")
+	parser.add_argument("--workers", type=int, nargs="+", default=[1, 8, 16], help="Numbers of scan workers to benchmark.")
+	args = parser.parse_args()
+	
+	with tempfile.TemporaryDirectory(prefix="scan-benchmark-") as root:
+		n_dirs, n_files = create_tree(root, args.depth, args.fanout, args.files_per_dir)
+		print("{:,} directories, {:,} files, {} ms per filesystem call".format(n_dirs, n_files, args.latency_ms))
+		print()
+		print("{:<22} {:>9} {:>9} {:>7}".format("", "Files", "Calls", "Sec"))
+		
+		runs = [("os.walk", lambda: run_os_walk(root))]
+		for workers in args.workers:
+			runs.append(("scanner, " + str(workers) + " worker(s)", lambda workers=workers: run_scanner(root, workers)))
+		for name, run in runs:
+			filesystem = SlowFilesystem(args.latency_ms / 1000)
+			filesystem.install()
+			try:
+				start_time = time.perf_counter()
+				n_listed = run()
+				time_taken_sec = time.perf_counter() - start_time
+			finally:
+				filesystem.uninstall()
+			print("{:<22} {:>9,} {:>9,} {:>7.2f}".format(name, n_listed, filesystem.get_calls(), time_taken_sec))
+
+
+if __name__ == "__main__":
+	main()
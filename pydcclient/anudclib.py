@@ -27,26 +27,162 @@ import base64
 import os
 import hashlib
 import configparser
+import re
 import logging
 import http.client
 import time
+import shutil
+import tempfile
+import uuid
+import fnmatch
+import collections
+import threading
+import concurrent.futures
+import multiprocessing
+import queue
+import signal
 from datetime import datetime
 
 from progress import ProgressFile
+from scan import FileScanner
+from scan import StatCache
+from spool import SpoolDict
+from transport import HttpTransport
 
 
 VERSION = "0.1-20140410"
 
+VERIFY_MATCHED = 1
+VERIFY_MISSING = 2
+VERIFY_MISMATCHED = 3
+
+EVENT_FILE_STARTED = "started"
+EVENT_FILE_PROGRESS = "progress"
+EVENT_FILE_FINISHED = "finished"
+
+REQUEST_RETRY_COUNT = 3
+# Responses that indicate the server is busy or temporarily unavailable, so the request may be retried.
+RETRY_STATUSES = (429, 502, 503, 504)
+
+# Number of parsed metadata files kept in memory.
+METADATA_CACHE_SIZE = 16
+# Section of a metadata file whose keys are included in every other section, as in configparser.
+DEFAULT_SECTION = configparser.DEFAULTSECT
+# Reference to another key in a metadata file value, as in configparser's BasicInterpolation.
+INTERPOLATION_KEY_RE = re.compile(r"%\(([^)]+)\)s")
+
+# Number of checksums kept in memory when there's no checksum cache file to save them to.
+CHECKSUM_CACHE_SIZE = 4096
+
+# Upper limit for the number of upload workers, including when changed while uploading.
+MAX_WORKERS = 64
+
+# Adaptive concurrency treats responses taking more than LATENCY_TOLERANCE times the lowest recent response time, and at
+# least LATENCY_MIN_INCREASE_SEC more, as a sign the server is overloaded.
+LATENCY_TOLERANCE = 2.0
+LATENCY_MIN_INCREASE_SEC = 0.02
+LATENCY_SMOOTHING = 0.2
+# The lowest response time is allowed to rise by this fraction per response so it follows lasting changes.
+LATENCY_BASELINE_DRIFT = 0.001
+THROUGHPUT_WINDOW_SEC = 10
+
+# Messages sent by worker processes of a multi-process upload to the coordinator.
+MESSAGE_OUTPUT = "output"
+MESSAGE_EVENT = "event"
+MESSAGE_STATUS = "status"
+MESSAGE_CHECKPOINT = "checkpoint"
+MESSAGE_CHECKSUMS = "checksums"
+MESSAGE_CONCURRENCY = "concurrency"
+
+# Flags in the upload state shared with worker processes.
+STATE_PAUSED = 1
+STATE_STOPPED = 2
+STATE_CANCELLED = 4
+
+WORKER_POLL_INTERVAL_SEC = 0.2
+CONCURRENCY_REPORT_INTERVAL_SEC = 1
+# Signals ignored by worker processes. Ctrl+C is sent to every process in the terminal's process group, and service
+# managers such as systemd signal every process of a service. Stopping, pausing and resuming are left to the coordinator.
+WORKER_IGNORED_SIGNALS = ("SIGINT", "SIGTERM", "SIGUSR1", "SIGUSR2")
+PROGRESS_REPORT_INTERVAL_SEC = 0.2
+
+# Delta uploads fall back to uploading the whole file if more than this fraction of it, or more than this number of
+# separate ranges, has changed.
+DELTA_MAX_FRACTION = 0.5
+DELTA_MAX_RANGES = 256
+
+DOWNLOAD_BLOCK_SIZE = 65536
+PARTIAL_FILE_SUFFIX = ".part"
+SEGMENTS_FILE_SUFFIX = ".segments"
+
 
 class AnudcClient:
-	def __init__(self):
-		self.__anudc_config = AnudcServerConfig()
+	def __init__(self, anudc_config=None, max_workers=None, sequential=None, processes=None, transport=None, delta=False, adaptive=None, spool_dir=None):
+		if anudc_config is None:
+			anudc_config = AnudcServerConfig()
+		self.__anudc_config = anudc_config
 		self.__hostname = self.__anudc_config.get_config_hostname()
 		self.__protocol = self.__anudc_config.get_config_protocol()
-		if self.__protocol == "https":
-			self.__conn = http.client.HTTPSConnection(self.__hostname)
+		
+		if max_workers is None:
+			max_workers = int(self.__anudc_config.get_config_max_workers())
+		max_workers = min(max(1, max_workers), MAX_WORKERS)
+		self.__max_workers = max_workers
+		
+		if processes is None:
+			processes = int(self.__anudc_config.get_config_processes())
+		self.__processes = max(1, processes)
+		
+		if transport is None:
+			transport = HttpTransport(self.__hostname, self.__protocol)
+		self.__transport = transport
+		
+		max_idle = max(max_workers, int(self.__anudc_config.get_config_verify_workers()))
+		self.__conn_pool = ConnectionPool(self.__transport, max_idle=max_idle)
+		self.__stat_cache = StatCache()
+		self.__file_scanner = FileScanner(self.__stat_cache, int(self.__anudc_config.get_config_scan_workers()))
+		self.__spool_dir = spool_dir
+		self.__checksum_cache = ChecksumCache(self.__anudc_config.get_config_checksum_cache(), spool_dir)
+		
+		# In delta mode, block digests of uploaded files are kept so that changed files can be patched on the server
+		# instead of uploaded again.
+		self.__delta_cache = None
+		if delta:
+			if self.__anudc_config.get_config_patchfileurl() is None:
+				raise Exception("Delta uploads need patchfile_url in anudc.conf.")
+			self.__delta_cache = DeltaCache(self.__anudc_config.get_config_delta_cache())
+			self.__delta_block_size = int(self.__anudc_config.get_config_delta_block_size())
+			if self.__delta_block_size <= 0 or self.__delta_block_size % 65536 != 0:
+				raise Exception("delta_block_size in anudc.conf must be a multiple of 65536.")
+		self.__limiter = ConcurrencyLimiter(max_workers)
+		self.__request_limiter = ConcurrencyLimiter(self.__get_request_workers())
+		self.__bandwidth_limiter = BandwidthLimiter(int(self.__anudc_config.get_config_bandwidth_limit()) * 1024)
+		self.__print_lock = threading.Lock()
+		
+		# With adaptive concurrency, the number of files uploaded and checked concurrently is adjusted according to how
+		# the server is coping, starting from the configured number, and the inter file upload delay isn't used. In a
+		# multi-process upload, each worker process adjusts its own number of uploads and reports its metrics, keyed on
+		# worker id, to this process.
+		if adaptive is None:
+			adaptive = self.__anudc_config.get_config_adaptive_concurrency()
+		self.__adaptive = bool(adaptive)
+		self.__upload_concurrency = None
+		self.__request_concurrency = None
+		self.__worker_concurrency_metrics = {}
+		if adaptive:
+			if self.__processes == 1:
+				self.__upload_concurrency = AdaptiveConcurrency("Upload", self.__limiter, max_limit=MAX_WORKERS)
+			self.__request_concurrency = AdaptiveConcurrency("Request", self.__request_limiter, max_limit=MAX_WORKERS)
+		
+		# A single worker keeps the original sequential behaviour, including progress display and the
+		# interactive inter file upload delay. Otherwise the executor is sized for the largest number of workers, and
+		# the limiter sets how many of its threads upload at a time, so the number of workers can be changed later.
+		if sequential is None:
+			sequential = max_workers == 1 and not adaptive
+		if sequential:
+			self.__executor = None
 		else:
-			self.__conn = http.client.HTTPConnection(self.__hostname)
+			self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS)
 
 	def __getuseragent(self):
 		return "Python/" + sys.version + " " + sys.platform
@@ -76,17 +212,32 @@ class AnudcClient:
 		return "%3.1f %s" % (num, 'TB')
 	
 	
-	def __calc_md5(self, filepath):
+	def __calc_md5(self, filepath, display=True, block_digests=None):
+		'''Returns the MD5 of a file, given its path or the file opened in binary mode. If a list is provided for
+		block_digests, the MD5 of each delta block of the file is appended to it.
+		'''
 		block_size = 65536
 		data_file = None
 		try:
-			data_file = ProgressFile(filepath, "rb")
+			data_file = ProgressFile(filepath, "rb", display=display)
 			digester = hashlib.md5()
+			block_digester = hashlib.md5()
+			block_bytes = 0
 		
 			data_block = data_file.read(block_size)
 			while len(data_block) > 0:
 				digester.update(data_block)
+				if block_digests is not None:
+					# Read blocks don't span delta blocks as the delta block size is a multiple of the read block size.
+					block_digester.update(data_block)
+					block_bytes += len(data_block)
+					if block_bytes >= self.__delta_block_size:
+						block_digests.append(block_digester.hexdigest())
+						block_digester = hashlib.md5()
+						block_bytes = 0
 				data_block = data_file.read(block_size)
+			if block_digests is not None and block_bytes > 0:
+				block_digests.append(block_digester.hexdigest())
 			
 			md5 = digester.hexdigest()
 		finally:
@@ -95,22 +246,81 @@ class AnudcClient:
 
 		return md5
 	
-	def __wait_inter_fileupload(self):
+	def __wait_inter_fileupload(self, control=None):
 		delay_sec = int(self.__anudc_config.get_config_inter_fileupload_delay())
 		if delay_sec > 0:
-			try:
-				for i in range(0,delay_sec):
-					if sys.stdout.isatty():
-						status_str = "\rWaiting " + str(i + 1) + "/" + str(delay_sec) + "..." 
-						print(status_str, end="")
-						sys.stdout.flush()
-					time.sleep(1)
-				print()
-			except KeyboardInterrupt:
-				try:
-					input("Press Enter key to continue...")
-				except (KeyboardInterrupt):
-					return
+			# Interrupting the uploader stops it through the UploadControl, so the wait ends early when stopped.
+			for i in range(0,delay_sec):
+				if control is not None and control.is_stopped():
+					break
+				if sys.stdout.isatty():
+					status_str = "\rWaiting " + str(i + 1) + "/" + str(delay_sec) + "..." 
+					print(status_str, end="")
+					sys.stdout.flush()
+				time.sleep(1)
+			print()
+	
+	
+	def get_max_workers(self):
+		return self.__limiter.get_limit()
+	
+	
+	def get_concurrency_metrics(self):
+		'''Returns the state of adaptive concurrency for uploads and for requests such as checking files, keyed on
+		"upload" and "request", or None if adaptive concurrency isn't enabled. With more than one process, the upload
+		metrics are the totals of those last reported by the worker processes.
+		'''
+		if not self.__adaptive:
+			return None
+		if self.__upload_concurrency is not None:
+			upload_metrics = self.__upload_concurrency.get_metrics()
+		else:
+			upload_metrics = combine_concurrency_metrics(list(self.__worker_concurrency_metrics.values()))
+		return {"upload": upload_metrics, "request": self.__request_concurrency.get_metrics()}
+	
+	
+	def get_processes(self):
+		return self.__processes
+	
+	
+	def set_max_workers(self, max_workers):
+		'''Sets the number of files uploaded concurrently. In a multi-process upload, this is the number of files uploaded
+		concurrently by each process.
+		'''
+		if self.__executor is None and self.__processes == 1:
+			raise Exception("The number of workers can't be changed when uploading one file at a time.")
+		self.__max_workers = min(max(1, max_workers), MAX_WORKERS)
+		# With adaptive concurrency, this is where adjustments continue from.
+		self.__limiter.set_limit(self.__max_workers)
+		return self.__max_workers
+	
+	
+	def get_bandwidth_limit(self):
+		return self.__bandwidth_limiter.get_rate()
+	
+	
+	def set_bandwidth_limit(self, bytes_per_sec):
+		'''Limits the total rate at which files are uploaded. A limit of 0 removes the limit.
+		'''
+		self.__bandwidth_limiter.set_rate(bytes_per_sec)
+	
+	
+	def get_checksum_cache(self):
+		return self.__checksum_cache
+	
+	
+	def get_file_scanner(self):
+		return self.__file_scanner
+	
+	
+	def close(self):
+		if self.__executor is not None:
+			self.__executor.shutdown()
+		self.__checksum_cache.save()
+		self.__checksum_cache.close()
+		if self.__delta_cache is not None:
+			self.__delta_cache.save()
+		self.__conn_pool.close_all()
 	
 	
 	def create_record(self, metadatafile):
@@ -118,6 +328,14 @@ class AnudcClient:
 		
 		self.__add_auth_header(headers)
 		
+		# The request key is saved in the metadata file before the record is created so that if the response is lost,
+		# running again sends the same key and the server returns the record already created instead of a duplicate.
+		request_key = metadatafile.read_request_key()
+		if request_key is None:
+			request_key = uuid.uuid4().hex
+			metadatafile.write_request_key(request_key)
+		headers["Idempotency-Key"] = request_key
+		
 		template = metadatafile.read_template()
 		
 		url = self.__anudc_config.get_config_createurl(template)
@@ -125,14 +343,11 @@ class AnudcClient:
 		print("Creating record at " + self.__hostname + url + " ...")
 		urlencoded_metadata = urllib.parse.urlencode(metadatafile.read_metadata_list())
 
-		self.__conn.request("POST", url, urlencoded_metadata, headers)
-		
-		response = self.__conn.getresponse()
-		print("Status: " + str(response.status) + ", (" + response.reason + ")")
-		body = str(response.read().decode("utf-8"))
+		status, reason, body = self.__post_with_retries(url, urlencoded_metadata, headers)
+		print("Status: " + str(status) + ", (" + reason + ")")
 		print("Body: " + body)
 		
-		if response.status == 201:
+		if status == 201 or status == 200:
 			print("Created record " + body)
 		else:
 			raise Exception("Unable to create record")
@@ -142,133 +357,1435 @@ class AnudcClient:
 
 
 	def create_relations(self, pid, relations):
+		'''Creates relations concurrently and returns their statuses, 1 for success or 0 for failure, keyed on
+		(link_type, related_pid).
+		'''
 		print()
-		if relations is not None:
-			for link_type, related_pid in relations:
-				headers = {"Content-Type": "application/x-www-form-urlencoded", "Accept": "text/plain", "User-Agent": self.__getuseragent()}
-				self.__add_auth_header(headers)
-			
-				url = self.__anudc_config.get_config_addlinkurl() + urllib.parse.quote(pid)
-				print("Creating relation: " + link_type + " " + related_pid)
-				urlencoded_link = urllib.parse.urlencode({"linkType": link_type, "itemId": related_pid})
+		relation_statuses = {}
+		if relations is not None and len(relations) > 0:
+			url = self.__anudc_config.get_config_addlinkurl() + urllib.parse.quote(pid)
+			with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(relations), self.__get_request_workers())) as executor:
+				futures = []
+				for link_type, related_pid in relations:
+					headers = {"Content-Type": "application/x-www-form-urlencoded", "Accept": "text/plain", "User-Agent": self.__getuseragent()}
+					self.__add_auth_header(headers)
+					urlencoded_link = urllib.parse.urlencode({"linkType": link_type, "itemId": related_pid})
+					futures.append(((link_type, related_pid), executor.submit(self.__post_with_retries, url, urlencoded_link, headers)))
 				
-				self.__conn.request("POST", url, urlencoded_link, headers)
-				
-				response = self.__conn.getresponse()
-				print("Status: " + str(response.status) + ", (" + response.reason + ")")
-				body = str(response.read().decode("utf-8"))
-				print("Body: " + body)
+				for relation, future in futures:
+					print("Creating relation: " + relation[0] + " " + relation[1])
+					try:
+						status, reason, body = future.result()
+						print("Status: " + str(status) + ", (" + reason + ")")
+						print("Body: " + body)
+						relation_statuses[relation] = 1 if status == 200 or status == 201 else 0
+					except Exception as e:
+						print("Error: " + str(e))
+						relation_statuses[relation] = 0
 		
+		return relation_statuses
 	
 	
-	def upload_files(self, pid, files_to_upload):
-		file_upload_statuses = {}
-		print()
-		cur_file_count = 0
-		n_files_to_upload = len(files_to_upload.items())
-		for target_path, local_filepath in files_to_upload.items():
-			cur_file_count += 1
-			print("Processing file (" + str(cur_file_count) + "/" + str(n_files_to_upload) + ") for " + pid + ":")
-			data_file = None
+	def __post_with_retries(self, url, body, headers):
+		'''POSTs a request, retrying on connection errors and responses indicating the server is busy or unavailable.
+		Returns a tuple of the status, reason and body of the last response.
+		'''
+		retry_delay = 1
+		for attempt in range(0, REQUEST_RETRY_COUNT):
+			conn = self.__conn_pool.acquire()
 			try:
-				# Check if the file exists.
-				if not os.path.isfile(local_filepath):
-					raise Exception("File " + local_filepath + " doesn't exist.")
-				
-				url = self.__anudc_config.get_config_uploadfileurl() + urllib.parse.quote(pid) + "/" + "data" + urllib.parse.quote(target_path)
-				
-				print("\tSource File: " + local_filepath + "  (" + self.__sizeof_fmt(os.path.getsize(local_filepath)) + ")")
-				print("\tTarget URL: " + self.__hostname + url)
+				conn.request("POST", url, body, headers)
+				response = conn.getresponse()
+				response_body = str(response.read().decode("utf-8"))
+				if response.status not in RETRY_STATUSES or attempt == REQUEST_RETRY_COUNT - 1:
+					return response.status, response.reason, response_body
+			except (http.client.HTTPException, OSError):
+				conn.close()
+				if attempt == REQUEST_RETRY_COUNT - 1:
+					raise
+			finally:
+				self.__conn_pool.release(conn)
+			time.sleep(retry_delay)
+			retry_delay *= 2
+	
+	
+	def __get_request_workers(self):
+		# Number of concurrent requests for small requests like HEAD checks and relations.
+		return max(self.__max_workers, int(self.__anudc_config.get_config_verify_workers()))
+		
+	
+	
+	def upload_files(self, pid, files_to_upload, file_upload_statuses=None, listener=None, control=None, checkpoint=None):
+		'''Uploads files to a collection and returns their statuses, keyed on local filepath. If a listener is provided it's
+		called with (event, local_filepath, value) as each file progresses, from the thread uploading the file. If an
+		UploadControl is provided, it can be used by other threads to pause, stop or cancel the upload. If an
+		UploadCheckpoint is provided, files it records as uploaded are skipped and newly uploaded files are added to it.
+		If the client has more than one process, files are uploaded by that many worker processes.
+		'''
+		if file_upload_statuses is None:
+			file_upload_statuses = {}
+		print()
+		n_files_to_upload = len(files_to_upload)
+		try:
+			if self.__processes > 1:
+				self.__upload_files_multiprocess(pid, files_to_upload, file_upload_statuses, listener, control, checkpoint)
+			elif self.__executor is None:
+				cur_file_count = 0
+				for target_path, local_filepath in files_to_upload.items():
+					if control is not None and not control.wait_if_paused():
+						break
+					cur_file_count += 1
+					status, uploaded = self.__upload_file(pid, target_path, local_filepath, cur_file_count, n_files_to_upload, print, True, listener, control, checkpoint)
+					file_upload_statuses[local_filepath] = status
+					if uploaded and cur_file_count < n_files_to_upload:
+						self.__wait_inter_fileupload(control);
+			else:
+				# Only a bounded number of files are submitted at a time so that memory use doesn't grow with the number of
+				# files to upload.
+				futures = {}
+				cur_file_count = 0
+				for target_path, local_filepath in files_to_upload.items():
+					if control is not None and not control.wait_if_paused():
+						break
+					cur_file_count += 1
+					if len(futures) >= self.__limiter.get_limit() * 2:
+						self.__collect_uploads(futures, file_upload_statuses, concurrent.futures.FIRST_COMPLETED)
+					future = self.__executor.submit(self.__upload_file_task, pid, target_path, local_filepath, cur_file_count, n_files_to_upload, listener, control, checkpoint)
+					futures[future] = local_filepath
+				self.__collect_uploads(futures, file_upload_statuses, concurrent.futures.ALL_COMPLETED)
+				if self.__upload_concurrency is not None:
+					print(self.__upload_concurrency.format_metrics())
+					print()
+		finally:
+			# Stats of local files are only trusted for one upload, as files may change before the next, e.g. when the
+			# client is kept for a GUI session.
+			self.__stat_cache.clear()
 
-				print("\tCalculating MD5: ", end="")
+		return file_upload_statuses
+	
+	
+	def __collect_uploads(self, futures, file_upload_statuses, return_when):
+		done, not_done = concurrent.futures.wait(futures, return_when=return_when)
+		for future in done:
+			local_filepath = futures.pop(future)
+			status = future.result()
+			# Files that were never started because the upload was stopped don't have a status.
+			if status is not None:
+				file_upload_statuses[local_filepath] = status
+	
+	
+	def __upload_files_multiprocess(self, pid, files_to_upload, file_upload_statuses, listener, control, checkpoint):
+		'''Splits files between worker processes, each with its own connections and upload threads, so that TLS and MD5
+		calculation aren't limited to one CPU. Files are handed out through a queue a few at a time so busy processes
+		don't hold on to files that others could upload. Output, statuses and progress are sent back through another
+		queue and reported from this thread.
+		'''
+		context = multiprocessing.get_context("spawn")
+		# Processes started here inherit the signals blocked by this thread. Blocking the signals workers ignore keeps
+		# them from being killed before they ignore them, and keeps multiprocessing's resource tracker, which is started
+		# when the first queue is created and only ignores SIGINT and SIGTERM, from being killed by SIGUSR1 or SIGUSR2.
+		def block_signals():
+			if hasattr(signal, "pthread_sigmask"):
+				return signal.pthread_sigmask(signal.SIG_BLOCK, get_worker_ignored_signals())
+		previous_signal_mask = block_signals()
+		try:
+			tasks = context.Queue()
+			results = context.Queue()
+			state = context.Value("i", 0)
+			workers_setting = context.Value("i", self.__max_workers)
+			bandwidth_setting = context.Value("d", self.__bandwidth_limiter.get_rate() / self.__processes)
+			
+			# Starting the resource tracker unblocks SIGINT and SIGTERM.
+			block_signals()
+			processes = []
+			for worker_id in range(self.__processes):
+				process = context.Process(target=upload_worker_process, args=(self.__anudc_config, self.__transport, self.__delta_cache is not None, self.__adaptive, self.__spool_dir, worker_id, pid, tasks, results, state, workers_setting, bandwidth_setting, listener is not None, checkpoint is not None), daemon=True)
+				process.start()
+				processes.append(process)
+		finally:
+			if previous_signal_mask is not None:
+				signal.pthread_sigmask(signal.SIG_SETMASK, previous_signal_mask)
+		
+		n_files_to_upload = len(files_to_upload)
+		cur_file_count = 0
+		files_iter = iter(files_to_upload.items())
+		files_exhausted = False
+		dispatched = set()
+		# Number of files uploaded successfully and unsuccessfully by each process.
+		worker_counts = [[0, 0] for process in processes]
+		self.__worker_concurrency_metrics = {}
+		
+		def handle_message(message):
+			if message[0] == MESSAGE_OUTPUT:
+				print(message[1], end="")
 				sys.stdout.flush()
-				start_time = datetime.now()
-				md = self.__calc_md5(local_filepath)
-				delta = datetime.now() - start_time
-				time_taken_sec = delta.seconds + (delta.microseconds / 1000000)
-				print("\tMD5: " + md + "     [Time taken " + "{:,.1f}".format(time_taken_sec) + " sec]")
-
-				headers = {"Content-Type": "application/octet-stream", "Accept": "text/plain", "Content-MD5": md, "User-Agent": self.__getuseragent()}
-				self.__add_auth_header(headers)
+			elif message[0] == MESSAGE_EVENT:
+				listener(message[1], message[2], message[3])
+			elif message[0] == MESSAGE_CHECKPOINT:
+				checkpoint.add(message[1], message[2], message[3])
+			elif message[0] == MESSAGE_CHECKSUMS:
+				self.__checksum_cache.update(message[1])
+				if self.__delta_cache is not None:
+					self.__delta_cache.update(message[2])
+			elif message[0] == MESSAGE_CONCURRENCY:
+				self.__worker_concurrency_metrics[message[1]] = message[2]
+			elif message[0] == MESSAGE_STATUS:
+				worker_id, local_filepath, status = message[1:]
+				dispatched.discard(local_filepath)
+				# Files that were never started because the upload was stopped don't have a status.
+				if status is not None:
+					file_upload_statuses[local_filepath] = status
+					worker_counts[worker_id][0 if status == 1 else 1] += 1
+		
+		try:
+			while True:
+				state.value = self.__get_upload_state(control)
+				workers_setting.value = self.__max_workers
+				bandwidth_setting.value = self.__bandwidth_limiter.get_rate() / self.__processes
 				
-				retry_count = 3
-				should_upload = True
-				response = None
-				while retry_count > 0:
+				# With adaptive concurrency, each process can raise its number of workers, so more files are made available.
+				max_dispatched = self.__processes * (MAX_WORKERS if self.__adaptive else self.__max_workers) * 2
+				while not files_exhausted and len(dispatched) < max_dispatched and state.value == 0:
 					try:
-						self.__conn.request("HEAD", url, None, headers)
-						response = self.__conn.getresponse()
-						if response.status != 404:
-							if response.getheader("Content-MD5") == md:
-								# Need to read whole response before sending next request
-								print("\tServer contains exact copy of " + local_filepath + ": SKIPPING.")
-								print()
-								file_upload_statuses[local_filepath] = 1
-								should_upload = False
-								break
-						retry_count = 0
-					except:
-						self.__conn.close()
-						time.sleep(10)
-						self.__conn.connect()
-						retry_count -= 1
-					finally:
-						if response != None:
-							response.read()
+						target_path, local_filepath = next(files_iter)
+					except StopIteration:
+						files_exhausted = True
+						break
+					cur_file_count += 1
+					if checkpoint is not None and checkpoint.contains(pid, target_path, local_filepath):
+						print("Processing file (" + str(cur_file_count) + "/" + str(n_files_to_upload) + ") for " + pid + ":")
+						print("\tUploaded in a previous run of " + local_filepath + ": SKIPPING.")
+						print()
+						file_upload_statuses[local_filepath] = 1
+						continue
+					tasks.put((target_path, local_filepath, cur_file_count, n_files_to_upload))
+					dispatched.add(local_filepath)
 				
-				if not should_upload:
+				if len(dispatched) == 0:
+					if files_exhausted or control is None or control.is_stopped():
+						break
+					control.wait_if_paused()
 					continue
 				
-				start_time = datetime.now()
-				retry_count = 3
-				while retry_count > 0:
-					try:
-						print("\tUploading: ", end="")
-						data_file = ProgressFile(local_filepath, "rb")
-						self.__conn.request("POST", url, data_file, headers)
-						retry_count = 0
-						response = self.__conn.getresponse()
-						print("\tResponse: [" + str(response.status) + ":" + response.reason + "] " + response.read().decode("utf-8"))
-						print("\tStatus: ", end="")
-						if response.status == 200 or response.status == 201:
-							file_upload_statuses[local_filepath] = 1
-							print("SUCCESS")
-						else:
-							file_upload_statuses[local_filepath] = 0
-							print("ERROR")
-					except:
-						e = sys.exc_info()[0]
-						print("Retrying because of:", e)
-						self.__conn.close()
-						time.sleep(10)
-						self.__conn.connect()
-						retry_count -= 1
-					finally:
-						if data_file is not None:
-							data_file.close()
-				
-				print
-			except Exception as e:
-				print()
-				print(e)
+				try:
+					handle_message(results.get(timeout=WORKER_POLL_INTERVAL_SEC))
+				except queue.Empty:
+					if not any(process.is_alive() for process in processes):
+						raise Exception("Upload processes exited before uploading all files.")
+		except BaseException:
+			state.value = STATE_STOPPED | STATE_CANCELLED
+			raise
+		finally:
+			for process in processes:
+				tasks.put(None)
+			# Results must be read until the processes exit, as processes don't exit until everything they've put in
+			# a queue has been read.
+			while any(process.is_alive() for process in processes) or not results.empty():
+				try:
+					handle_message(results.get(timeout=WORKER_POLL_INTERVAL_SEC))
+				except queue.Empty:
+					pass
+			for local_filepath in dispatched:
 				file_upload_statuses[local_filepath] = 0
+		
+		print("Upload processes: " + ", ".join("{} successful {} failed".format(successful, failed) for successful, failed in worker_counts))
+		if self.__adaptive:
+			print(format_concurrency_metrics("Upload", self.get_concurrency_metrics()["upload"]) + ", total of " + str(len(processes)) + " processes")
+		print()
+	
+	
+	def __get_upload_state(self, control):
+		state = 0
+		if control is not None:
+			if control.is_paused():
+				state |= STATE_PAUSED
+			if control.is_stopped():
+				state |= STATE_STOPPED
+			if control.is_cancelled():
+				state |= STATE_CANCELLED
+		return state
+	
+	
+	def run_upload_worker(self, worker_id, pid, tasks, results, state, workers_setting, bandwidth_setting, report_progress, use_checkpoint):
+		'''Uploads files read from the tasks queue until None is read, sending output, statuses and progress to the
+		results queue. Run by each worker process of a multi-process upload.
+		'''
+		control = UploadControl()
+		def report_concurrency():
+			if self.__upload_concurrency is not None:
+				results.put((MESSAGE_CONCURRENCY, worker_id, self.__upload_concurrency.get_metrics()))
+		follower = threading.Thread(target=self.__follow_coordinator, args=(control, state, workers_setting, bandwidth_setting, report_concurrency), daemon=True)
+		follower.start()
+		
+		listener = None
+		if report_progress:
+			listener = self.__create_progress_reporter(results)
+		checkpoint = None
+		if use_checkpoint:
+			checkpoint = RemoteCheckpoint(results)
+		
+		def write_output(text):
+			results.put((MESSAGE_OUTPUT, text))
+		
+		def report_status(future, local_filepath):
+			try:
+				status = future.result()
+			except Exception as e:
+				write_output(str(e) + "\n")
+				status = 0
+			results.put((MESSAGE_STATUS, worker_id, local_filepath, status))
+		
+		futures = set()
+		while True:
+			task = tasks.get()
+			if task is None:
+				break
+			target_path, local_filepath, cur_file_count, n_files_to_upload = task
+			future = self.__executor.submit(self.__upload_file_task, pid, target_path, local_filepath, cur_file_count, n_files_to_upload, listener, control, checkpoint, write_output)
+			future.add_done_callback(lambda future, local_filepath=local_filepath: report_status(future, local_filepath))
+			futures.add(future)
+			# Only take another file once there's a free worker, so files waiting in the queue go to idle processes.
+			while len(futures) >= self.__limiter.get_limit():
+				done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+		concurrent.futures.wait(futures)
+		report_concurrency()
+		
+		# Checksums are saved by the coordinator so processes don't overwrite each other's cache file.
+		delta_updates = []
+		if self.__delta_cache is not None:
+			delta_updates = self.__delta_cache.pop_updates()
+		results.put((MESSAGE_CHECKSUMS, self.__checksum_cache.pop_updates(), delta_updates))
+	
+	
+	def __follow_coordinator(self, control, state, workers_setting, bandwidth_setting, report_concurrency):
+		last_reported = time.monotonic()
+		while True:
+			if state.value & STATE_CANCELLED:
+				control.cancel()
+			elif state.value & STATE_STOPPED:
+				control.stop()
+			elif state.value & STATE_PAUSED:
+				control.pause()
+			else:
+				control.resume()
+			if workers_setting.value != self.__max_workers:
+				self.set_max_workers(workers_setting.value)
+			if int(bandwidth_setting.value) != self.__bandwidth_limiter.get_rate():
+				self.__bandwidth_limiter.set_rate(int(bandwidth_setting.value))
+			if time.monotonic() - last_reported >= CONCURRENCY_REPORT_INTERVAL_SEC:
+				report_concurrency()
+				last_reported = time.monotonic()
+			time.sleep(WORKER_POLL_INTERVAL_SEC)
+	
+	
+	def __create_progress_reporter(self, results):
+		# Progress is reported at most every PROGRESS_REPORT_INTERVAL_SEC per file to keep the results queue small.
+		last_reported = {}
+		lock = threading.Lock()
+		def report_event(event, local_filepath, value):
+			if event == EVENT_FILE_PROGRESS:
+				now = time.monotonic()
+				with lock:
+					if now - last_reported.get(local_filepath, 0) < PROGRESS_REPORT_INTERVAL_SEC:
+						return
+					last_reported[local_filepath] = now
+			elif event == EVENT_FILE_FINISHED:
+				with lock:
+					last_reported.pop(local_filepath, None)
+			results.put((MESSAGE_EVENT, event, local_filepath, value))
+		return report_event
+	
+	
+	def __upload_file_task(self, pid, target_path, local_filepath, cur_file_count, n_files_to_upload, listener, control, checkpoint, write_output=None):
+		# Output of each file is buffered and printed as a block so that concurrent uploads don't interleave.
+		output = []
+		def log(text="", end="\n"):
+			output.append(text + end)
+		
+		with self.__limiter:
+			if control is not None and not control.wait_if_paused():
+				return None
+			try:
+				status, uploaded = self.__upload_file(pid, target_path, local_filepath, cur_file_count, n_files_to_upload, log, False, listener, control, checkpoint)
+			finally:
+				if write_output is not None:
+					write_output("".join(output))
+				else:
+					with self.__print_lock:
+						print("".join(output), end="")
+						sys.stdout.flush()
+			
+			delay_sec = int(self.__anudc_config.get_config_inter_fileupload_delay())
+			if uploaded and delay_sec > 0 and not self.__adaptive and not (control is not None and control.is_stopped()):
+				time.sleep(delay_sec)
+		
+		return status
+	
+	
+	def __upload_file(self, pid, target_path, local_filepath, cur_file_count, n_files_to_upload, log, display, listener=None, control=None, checkpoint=None):
+		status = 0
+		uploaded = True
+		log("Processing file (" + str(cur_file_count) + "/" + str(n_files_to_upload) + ") for " + pid + ":")
+		data_file = None
+		response = None
+		conn = self.__conn_pool.acquire()
+		try:
+			# Check if the file exists.
+			if not self.__stat_cache.isfile(local_filepath):
+				raise Exception("File " + local_filepath + " doesn't exist.")
+			
+			url = self.__get_file_url(pid, target_path)
+			
+			file_size = self.__stat_cache.getsize(local_filepath)
+			log("\tSource File: " + local_filepath + "  (" + self.__sizeof_fmt(file_size) + ")")
+			if listener is not None:
+				listener(EVENT_FILE_STARTED, local_filepath, file_size)
+			
+			if checkpoint is not None and checkpoint.contains(pid, target_path, local_filepath):
+				log("\tUploaded in a previous run of " + local_filepath + ": SKIPPING.")
+				log()
+				status = 1
+				uploaded = False
+				return status, uploaded
+			log("\tTarget URL: " + self.__hostname + url)
+
+			log("\tCalculating MD5: ", end="")
+			sys.stdout.flush()
+			start_time = datetime.now()
+			# In delta mode, block digests are calculated along with the MD5. If the MD5 was cached, they're only
+			# calculated when needed.
+			block_digests = None
+			if self.__delta_cache is not None:
+				block_digests = []
+			md = self.__checksum_cache.get_md5(local_filepath, lambda fp: self.__calc_md5(fp, display, block_digests))
+			def get_block_digests():
+				if len(block_digests) == 0 and file_size > 0:
+					self.__calc_md5(local_filepath, False, block_digests)
+				return block_digests
+			delta_key = self.__hostname + url
+			delta = datetime.now() - start_time
+			time_taken_sec = delta.seconds + (delta.microseconds / 1000000)
+			log("\tMD5: " + md + "     [Time taken " + "{:,.1f}".format(time_taken_sec) + " sec]")
+
+			headers = {"Content-Type": "application/octet-stream", "Accept": "text/plain", "Content-MD5": md, "User-Agent": self.__getuseragent()}
+			self.__add_auth_header(headers)
+			
+			server_md5 = None
+			retry_count = 3
+			busy_retry_count = REQUEST_RETRY_COUNT - 1
+			busy_retry_delay = 1
+			while retry_count > 0:
+				request_time = time.monotonic()
+				try:
+					conn.request("HEAD", url, None, headers)
+					response = conn.getresponse()
+					if self.__upload_concurrency is not None:
+						self.__upload_concurrency.record(response.status, time.monotonic() - request_time)
+					# Otherwise a busy server would be taken as not having the file and the whole file uploaded again.
+					if response.status in RETRY_STATUSES and busy_retry_count > 0:
+						log("\tServer busy, retrying in " + str(busy_retry_delay) + " sec")
+						time.sleep(busy_retry_delay)
+						busy_retry_count -= 1
+						busy_retry_delay *= 2
+						continue
+					if response.status != 404:
+						server_md5 = response.getheader("Content-MD5")
+						if server_md5 == md:
+							# Need to read whole response before sending next request
+							log("\tServer contains exact copy of " + local_filepath + ": SKIPPING.")
+							log()
+							if checkpoint is not None:
+								checkpoint.add(pid, target_path, local_filepath)
+							if self.__delta_cache is not None and self.__delta_cache.get_md5(delta_key) != md:
+								self.__delta_cache.put(delta_key, md, self.__delta_block_size, get_block_digests())
+							status = 1
+							uploaded = False
+							return status, uploaded
+					retry_count = 0
+				except:
+					if self.__upload_concurrency is not None:
+						self.__upload_concurrency.record(None)
+					conn.close()
+					time.sleep(10)
+					conn.connect()
+					retry_count -= 1
+				finally:
+					if response != None:
+						response.read()
+			
+			last_bytes_read = [0]
+			def progress_callback(bytes_read):
+				if control is not None and control.is_cancelled():
+					raise UploadCancelled("Upload of " + local_filepath + " cancelled.")
+				# bytes_read starts again from 0 if the upload is retried.
+				self.__bandwidth_limiter.consume(max(0, bytes_read - last_bytes_read[0]))
+				last_bytes_read[0] = bytes_read
+				if listener is not None:
+					listener(EVENT_FILE_PROGRESS, local_filepath, bytes_read)
+			
+			if self.__delta_cache is not None and server_md5 is not None:
+				ranges = self.__get_delta_ranges(self.__delta_cache.get(delta_key), server_md5, get_block_digests(), file_size)
+				if ranges is not None and self.__patch_file(pid, target_path, local_filepath, ranges, file_size, md, server_md5, conn, log, display, progress_callback):
+					status = 1
+					log("\tStatus: SUCCESS")
+					if checkpoint is not None:
+						checkpoint.add(pid, target_path, local_filepath)
+					self.__delta_cache.put(delta_key, md, self.__delta_block_size, get_block_digests())
+					return status, uploaded
+			
+			retry_count = 3
+			busy_retry_count = REQUEST_RETRY_COUNT - 1
+			busy_retry_delay = 1
+			while retry_count > 0:
+				try:
+					log("\tUploading: ", end="")
+					data_file = ProgressFile(local_filepath, "rb", display=display, callback=progress_callback)
+					conn.request("POST", url, data_file, headers)
+					retry_count = 0
+					response = conn.getresponse()
+					log("\tResponse: [" + str(response.status) + ":" + response.reason + "] " + response.read().decode("utf-8"))
+					if self.__upload_concurrency is not None:
+						# Upload response times depend on the size of the file, so only the status is used.
+						self.__upload_concurrency.record(response.status, num_bytes=file_size if response.status in (200, 201) else 0)
+					if response.status in RETRY_STATUSES and busy_retry_count > 0:
+						log("\tServer busy, retrying in " + str(busy_retry_delay) + " sec")
+						time.sleep(busy_retry_delay)
+						busy_retry_count -= 1
+						busy_retry_delay *= 2
+						retry_count = 1
+						continue
+					log("\tStatus: ", end="")
+					if response.status == 200 or response.status == 201:
+						status = 1
+						log("SUCCESS")
+						if checkpoint is not None:
+							checkpoint.add(pid, target_path, local_filepath)
+						if self.__delta_cache is not None:
+							self.__delta_cache.put(delta_key, md, self.__delta_block_size, get_block_digests())
+					else:
+						status = 0
+						log("ERROR")
+				except UploadCancelled:
+					conn.close()
+					raise
+				except:
+					e = sys.exc_info()[0]
+					log("Retrying because of: " + str(e))
+					if self.__upload_concurrency is not None:
+						self.__upload_concurrency.record(None)
+					conn.close()
+					time.sleep(10)
+					conn.connect()
+					retry_count -= 1
+				finally:
+					if data_file is not None:
+						data_file.close()
+		except Exception as e:
+			log()
+			log(str(e))
+			status = 0
+		finally:
+			if data_file is not None:
+				data_file.close()
+			if response is not None:
+				response.read()
+			self.__conn_pool.release(conn)
+			if listener is not None:
+				listener(EVENT_FILE_FINISHED, local_filepath, status)
+		
+		return status, uploaded
+	
+	
+	def __get_delta_ranges(self, entry, server_md5, block_digests, file_size):
+		'''Returns the (start, length) ranges of a file that differ from the copy on the server, with adjacent changed
+		blocks merged. Returns None if the block digests of the copy on the server aren't known, or too much of the file
+		has changed for patching to be worthwhile.
+		'''
+		if entry is None:
+			return None
+		md5, block_size, server_digests = entry
+		if md5 != server_md5 or block_size != self.__delta_block_size:
+			return None
+		
+		ranges = []
+		for i, digest in enumerate(block_digests):
+			if i < len(server_digests) and server_digests[i] == digest:
+				continue
+			start = i * block_size
+			length = min(block_size, file_size - start)
+			if len(ranges) > 0 and ranges[-1][0] + ranges[-1][1] == start:
+				ranges[-1] = (ranges[-1][0], ranges[-1][1] + length)
+			else:
+				ranges.append((start, length))
+		
+		# No changed blocks means the file was truncated at a block boundary, which can be patched with no data.
+		if len(ranges) == 0 and len(block_digests) == len(server_digests):
+			return None
+		if sum(length for start, length in ranges) > file_size * DELTA_MAX_FRACTION or len(ranges) > DELTA_MAX_RANGES:
+			return None
+		return ranges
+	
+	
+	def __patch_file(self, pid, target_path, local_filepath, ranges, file_size, md5, server_md5, conn, log, display, progress_callback):
+		'''Sends the changed ranges of a file to the server, which applies them to its copy. Each range is a separate
+		request with the same X-Patch-Id. The first request has the MD5 of the copy the ranges were calculated against in
+		If-Match, and the last has the MD5 of the whole file in Content-MD5, so the server only replaces its copy when
+		every range has been received and the result is correct. Returns True if the file was patched.
+		'''
+		url = self.__anudc_config.get_config_patchfileurl() + urllib.parse.quote(pid) + "/" + "data" + urllib.parse.quote(target_path)
+		log("\tPatching: " + str(len(ranges)) + " changed range(s), " + self.__sizeof_fmt(sum(length for start, length in ranges)) + " of " + self.__sizeof_fmt(file_size))
+		patch_id = uuid.uuid4().hex
+		bytes_sent = 0
+		# A file truncated at a block boundary is patched with a single request with no data.
+		requests = ranges if len(ranges) > 0 else [(0, 0)]
+		for i, (start, length) in enumerate(requests):
+			headers = {"Content-Type": "application/octet-stream", "Accept": "text/plain", "User-Agent": self.__getuseragent(), "X-Patch-Id": patch_id}
+			self.__add_auth_header(headers)
+			if i == 0:
+				headers["If-Match"] = server_md5
+			if i == len(requests) - 1:
+				headers["Content-MD5"] = md5
+			data_file = None
+			if length > 0:
+				headers["Content-Range"] = "bytes {}-{}/{}".format(start, start + length - 1, file_size)
+				headers["Content-Length"] = str(length)
+				data_file = ProgressFile(local_filepath, "rb", display=display, callback=lambda bytes_read: progress_callback(bytes_sent + bytes_read), start=start, length=length)
+			else:
+				headers["Content-Range"] = "bytes */" + str(file_size)
+			try:
+				conn.request("POST", url, data_file, headers)
+				response = conn.getresponse()
+				response_body = response.read().decode("utf-8")
+			except (http.client.HTTPException, OSError) as e:
+				conn.close()
+				log("\tUnable to patch file, uploading whole file: " + str(e))
+				return False
 			finally:
 				if data_file is not None:
 					data_file.close()
-				if response is not None:
-					response.read()
-					
-			if cur_file_count < n_files_to_upload:
-				self.__wait_inter_fileupload();
+			if response.status not in (200, 201, 202, 204):
+				log("\tUnable to patch file, uploading whole file: [" + str(response.status) + ":" + response.reason + "] " + response_body)
+				return False
+			bytes_sent += length
+		return True
+	
+	
+	def list_files(self, pid):
+		'''Returns the target paths of all files in a collection, or None if listfiles_url isn't configured.
+		'''
+		url = self.__anudc_config.get_config_listfilesurl()
+		if url is None:
+			return None
+		
+		headers = {"Accept": "text/plain", "User-Agent": self.__getuseragent()}
+		self.__add_auth_header(headers)
+		
+		conn = self.__conn_pool.acquire()
+		try:
+			conn.request("GET", url + urllib.parse.quote(pid), None, headers)
+			response = conn.getresponse()
+			body = response.read().decode("utf-8")
+		finally:
+			self.__conn_pool.release(conn)
+		
+		if response.status != 200:
+			raise Exception("Unable to list files in " + pid + ": [" + str(response.status) + ":" + response.reason + "]")
+		
+		return [line.strip() for line in body.splitlines() if line.strip() != ""]
+	
+	
+	def verify_files(self, pid, files_to_verify, control=None):
+		'''Compares local files against the files in a collection without uploading anything. Returns a VerifyResult
+		listing the files that are missing from the collection, that differ from the local copy, that couldn't be
+		checked, and that exist in the collection but not locally. If an UploadControl is provided, it can be used to
+		pause or stop checking files.
+		'''
+		result = VerifyResult()
+		target_paths = set()
+		# The request limiter sets how many files are checked at a time. With adaptive concurrency it can rise above the
+		# configured number.
+		max_workers = self.__get_request_workers()
+		if self.__request_concurrency is not None:
+			max_workers = MAX_WORKERS
+		
+		print()
+		print("Verifying " + str(len(files_to_verify)) + " file(s) against " + pid + " ...")
+		with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+			futures = {}
+			for target_path, local_filepath in files_to_verify.items():
+				if control is not None and not control.wait_if_paused():
+					break
+				target_paths.add(target_path)
+				if len(futures) >= max_workers * 2:
+					self.__collect_verifications(futures, result, concurrent.futures.FIRST_COMPLETED)
+				futures[executor.submit(self.__verify_file, pid, target_path, local_filepath)] = target_path
+			self.__collect_verifications(futures, result, concurrent.futures.ALL_COMPLETED)
+		self.__stat_cache.clear()
+		if self.__request_concurrency is not None:
+			print(self.__request_concurrency.format_metrics())
+		
+		server_paths = self.list_files(pid)
+		if server_paths is not None:
+			result.extra = sorted([path for path in server_paths if path not in target_paths])
+		
+		return result
+	
+	
+	def __collect_verifications(self, futures, result, return_when):
+		done, not_done = concurrent.futures.wait(futures, return_when=return_when)
+		for future in done:
+			target_path = futures.pop(future)
+			status = future.result()
+			if status == VERIFY_MATCHED:
+				result.matched_count += 1
+			elif status == VERIFY_MISSING:
+				result.missing.append(target_path)
+			elif status == VERIFY_MISMATCHED:
+				result.mismatched.append(target_path)
+			else:
+				result.errors.append((target_path, status))
+	
+	
+	def __verify_file(self, pid, target_path, local_filepath):
+		try:
+			md = self.__checksum_cache.get_md5(local_filepath, lambda fp: self.__calc_md5(fp, False))
+		except OSError as e:
+			return str(e)
+		
+		headers = {"Accept": "text/plain", "User-Agent": self.__getuseragent()}
+		self.__add_auth_header(headers)
+		url = self.__get_file_url(pid, target_path)
+		
+		conn = self.__conn_pool.acquire()
+		try:
+			with self.__request_limiter:
+				retry_count = 2
+				busy_retry_count = REQUEST_RETRY_COUNT - 1
+				busy_retry_delay = 1
+				while True:
+					request_time = time.monotonic()
+					try:
+						conn.request("HEAD", url, None, headers)
+						response = conn.getresponse()
+						response.read()
+						if self.__request_concurrency is not None:
+							self.__request_concurrency.record(response.status, time.monotonic() - request_time)
+						if response.status in RETRY_STATUSES and busy_retry_count > 0:
+							time.sleep(busy_retry_delay)
+							busy_retry_count -= 1
+							busy_retry_delay *= 2
+							continue
+						break
+					except (http.client.HTTPException, OSError):
+						if self.__request_concurrency is not None:
+							self.__request_concurrency.record(None)
+						conn.close()
+						retry_count -= 1
+						if retry_count == 0:
+							raise
+		except Exception as e:
+			return "Unable to check file: " + str(e)
+		finally:
+			self.__conn_pool.release(conn)
+		
+		if response.status == 404:
+			return VERIFY_MISSING
+		elif response.status != 200:
+			return "[" + str(response.status) + ":" + response.reason + "]"
+		elif response.getheader("Content-MD5") == md:
+			return VERIFY_MATCHED
+		else:
+			return VERIFY_MISMATCHED
+	
+	
+	def download_files(self, pid, target_dir, patterns=None, control=None):
+		'''Downloads the files in a collection whose paths match any of the glob patterns, or all files if no patterns are
+		specified, to target_dir. Returns a dict of download statuses keyed on the path of each file in the collection. If
+		an UploadControl is provided, it can be used to pause, stop or cancel downloading, as for uploads.
+		'''
+		server_paths = self.list_files(pid)
+		if server_paths is None:
+			raise Exception("Unable to list files in " + pid + " as listfiles_url is not configured.")
+		if patterns:
+			server_paths = [path for path in server_paths if any(fnmatch.fnmatchcase(path, pattern) for pattern in patterns)]
+		
+		file_download_statuses = {}
+		max_workers = max(self.__max_workers, int(self.__anudc_config.get_config_download_workers()))
+		
+		print()
+		print("Downloading " + str(len(server_paths)) + " file(s) from " + pid + " to " + target_dir + " ...")
+		# Large files are split into segments that are downloaded by a separate pool so that a file task waiting on its
+		# segments never holds up the segments themselves.
+		with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as file_executor, concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as segment_executor:
+			futures = {}
+			for server_path in server_paths:
+				# Ignore relative path components so files can't be written outside target_dir.
+				local_filepath = os.path.join(target_dir, *[part for part in server_path.split("/") if part not in ("", ".", "..")])
+				futures[file_executor.submit(self.__download_file, pid, server_path, local_filepath, segment_executor, control)] = server_path
+			for future in concurrent.futures.as_completed(futures):
+				status = future.result()
+				# Files that were never started because downloading was stopped don't have a status.
+				if status is not None:
+					file_download_statuses[futures[future]] = status
+		
+		return file_download_statuses
+	
+	
+	def __download_file(self, pid, server_path, local_filepath, segment_executor, control):
+		if control is not None and not control.wait_if_paused():
+			return None
+		output = ["Downloading " + server_path + " to " + local_filepath + ":\n"]
+		status = 0
+		try:
+			url = self.__get_file_url(pid, server_path)
+			headers = {"User-Agent": self.__getuseragent()}
+			self.__add_auth_header(headers)
+			
+			response = self.__request("HEAD", url, headers)
+			if response.status != 200:
+				raise Exception("Unable to get file details: [" + str(response.status) + ":" + response.reason + "]")
+			server_md5 = response.getheader("Content-MD5")
+			content_length = response.getheader("Content-Length")
+			if content_length is not None:
+				content_length = int(content_length)
+			
+			if os.path.isfile(local_filepath) and server_md5 is not None and self.__checksum_cache.get_md5(local_filepath, lambda fp: self.__calc_md5(fp, False)) == server_md5:
+				output.append("\tLocal file is an exact copy: SKIPPING.\n")
+				return 1
+			
+			os.makedirs(os.path.dirname(os.path.abspath(local_filepath)), exist_ok=True)
+			partial_filepath = local_filepath + PARTIAL_FILE_SUFFIX
+			start_time = datetime.now()
+			segment_size = int(self.__anudc_config.get_config_download_segment_size())
+			if content_length is not None and content_length > segment_size:
+				self.__download_segments(url, headers, partial_filepath, content_length, segment_size, segment_executor, control)
+			else:
+				self.__download_range(url, headers, partial_filepath, None, None, resume=True, control=control)
+			delta = datetime.now() - start_time
+			time_taken_sec = delta.seconds + (delta.microseconds / 1000000)
+			
+			size = os.path.getsize(partial_filepath)
+			if content_length is not None and size != content_length:
+				raise Exception("Downloaded " + str(size) + " bytes, expected " + str(content_length) + ". Partial file kept to resume later.")
+			
+			local_md5 = self.__calc_md5(partial_filepath, False)
+			if server_md5 is not None and local_md5 != server_md5:
+				os.remove(partial_filepath)
+				raise Exception("MD5 mismatch. Expected " + server_md5 + ", got " + local_md5 + ".")
+			
+			os.replace(partial_filepath, local_filepath)
+			self.__delete_if_exists(partial_filepath + SEGMENTS_FILE_SUFFIX)
+			output.append("\tMD5: " + local_md5 + "  (" + self.__sizeof_fmt(size) + " in " + "{:,.1f}".format(time_taken_sec) + " sec)\n")
+			output.append("\tStatus: SUCCESS\n")
+			status = 1
+		except Exception as e:
+			output.append("\tStatus: ERROR - " + str(e) + "\n")
+		finally:
+			with self.__print_lock:
+				print("".join(output), end="")
+				sys.stdout.flush()
+		
+		return status
+	
+	
+	def __download_segments(self, url, headers, partial_filepath, content_length, segment_size, segment_executor, control):
+		# Segments that have been completely downloaded are recorded in a segments file alongside the partial file so
+		# that an interrupted download only needs to fetch the remaining segments.
+		segments_filepath = partial_filepath + SEGMENTS_FILE_SUFFIX
+		completed_segments = set()
+		if os.path.isfile(partial_filepath) and os.path.isfile(segments_filepath):
+			with open(segments_filepath, "r") as fp:
+				completed_segments = set(int(line) for line in fp if line.strip() != "")
+		else:
+			# Preallocate so segments can be written in any order.
+			with open(partial_filepath, "wb") as fp:
+				fp.truncate(content_length)
+			with open(segments_filepath, "w"):
+				pass
+		
+		segments_lock = threading.Lock()
+		def download_segment(start):
+			end = min(start + segment_size, content_length) - 1
+			self.__download_range(url, headers, partial_filepath, start, end, control=control)
+			with segments_lock:
+				with open(segments_filepath, "a") as fp:
+					fp.write(str(start) + "\n")
+		
+		starts = [start for start in range(0, content_length, segment_size) if start not in completed_segments]
+		# The first segment is downloaded before the others so that if the server doesn't support range requests, the file
+		# is downloaded with a single request instead.
+		if len(starts) > 0:
+			try:
+				download_segment(starts[0])
+			except RangeNotSupported:
+				self.__delete_if_exists(segments_filepath)
+				self.__download_range(url, headers, partial_filepath, None, None, control=control)
+				return
+		
+		futures = [segment_executor.submit(download_segment, start) for start in starts[1:]]
+		for future in futures:
+			future.result()
+	
+	
+	def __download_range(self, url, headers, filepath, start, end, resume=False, control=None):
+		'''Streams bytes start to end (inclusive) of a file on the server into the same offsets of a local file. If start
+		is None, the whole file is downloaded, resuming from the end of the local file if resume is True. Raises
+		DownloadCancelled if the UploadControl provided is cancelled.
+		'''
+		headers = dict(headers)
+		offset = 0
+		if start is not None:
+			headers["Range"] = "bytes=" + str(start) + "-" + str(end)
+			offset = start
+		elif resume and os.path.isfile(filepath) and os.path.getsize(filepath) > 0:
+			offset = os.path.getsize(filepath)
+			headers["Range"] = "bytes=" + str(offset) + "-"
+		
+		conn = self.__conn_pool.acquire()
+		try:
+			conn.request("GET", url, None, headers)
+			response = conn.getresponse()
+			if response.status == 416 and start is None:
+				# Partial file is already complete.
+				response.read()
+				return
+			if response.status == 200:
+				if start is not None:
+					raise RangeNotSupported("Server doesn't support range requests.")
+				# Server ignored the range, so start from the beginning.
+				offset = 0
+			elif response.status != 206:
+				response.read()
+				raise Exception("Unable to download file: [" + str(response.status) + ":" + response.reason + "]")
+			
+			if start is None:
+				mode = "ab" if offset > 0 else "wb"
+			else:
+				mode = "r+b"
+			with open(filepath, mode) as fp:
+				if start is not None:
+					fp.seek(offset)
+				data_block = response.read(DOWNLOAD_BLOCK_SIZE)
+				while len(data_block) > 0:
+					fp.write(data_block)
+					if control is not None and control.is_cancelled():
+						raise DownloadCancelled("Download cancelled. Partial file kept to resume later.")
+					data_block = response.read(DOWNLOAD_BLOCK_SIZE)
+		except:
+			conn.close()
+			raise
+		finally:
+			self.__conn_pool.release(conn)
+	
+	
+	def __request(self, method, url, headers):
+		'''Sends a request without a body, retrying responses indicating the server is busy or unavailable. Returns the last
+		response, which has been read.
+		'''
+		retry_delay = 1
+		for attempt in range(0, REQUEST_RETRY_COUNT):
+			conn = self.__conn_pool.acquire()
+			try:
+				conn.request(method, url, None, headers)
+				response = conn.getresponse()
+				response.read()
+			except:
+				conn.close()
+				raise
+			finally:
+				self.__conn_pool.release(conn)
+			if response.status not in RETRY_STATUSES or attempt == REQUEST_RETRY_COUNT - 1:
+				return response
+			time.sleep(retry_delay)
+			retry_delay *= 2
+	
+	
+	def __delete_if_exists(self, filepath):
+		if os.path.isfile(filepath):
+			os.remove(filepath)
+	
+	
+	def __get_file_url(self, pid, target_path):
+		return self.__anudc_config.get_config_uploadfileurl() + urllib.parse.quote(pid) + "/" + "data" + urllib.parse.quote(target_path)
 
-		return file_upload_statuses
 
+def upload_worker_process(anudc_config, transport, delta, adaptive, spool_dir, worker_id, pid, tasks, results, state, workers_setting, bandwidth_setting, report_progress, use_checkpoint):
+	'''Entry point of the worker processes of a multi-process upload.
+	'''
+	for signum in get_worker_ignored_signals():
+		signal.signal(signum, signal.SIG_IGN)
+	anudc = AnudcClient(anudc_config, max_workers=workers_setting.value, sequential=False, processes=1, transport=transport, delta=delta, adaptive=adaptive, spool_dir=spool_dir)
+	anudc.set_bandwidth_limit(int(bandwidth_setting.value))
+	try:
+		anudc.run_upload_worker(worker_id, pid, tasks, results, state, workers_setting, bandwidth_setting, report_progress, use_checkpoint)
+	finally:
+		anudc.close()
+
+
+def get_worker_ignored_signals():
+	return [getattr(signal, signal_name) for signal_name in WORKER_IGNORED_SIGNALS if hasattr(signal, signal_name)]
+
+
+class UploadCancelled(Exception):
+	pass
+
+
+class DownloadCancelled(Exception):
+	pass
+
+
+class RangeNotSupported(Exception):
+	pass
+
+
+class UploadControl:
+	'''Lets other threads pause, resume, stop or cancel an upload. Stopping lets files that are being uploaded finish but
+	doesn't start any others. Cancelling also aborts files that are being uploaded.
+	'''
+	def __init__(self):
+		self.__paused = False
+		self.__stopped = False
+		self.__cancelled = False
+		self.__cond = threading.Condition()
 	
-class AnudcServerConfig:
+	def pause(self):
+		with self.__cond:
+			self.__paused = True
+	
+	def resume(self):
+		with self.__cond:
+			self.__paused = False
+			self.__cond.notify_all()
+	
+	def stop(self):
+		with self.__cond:
+			self.__stopped = True
+			self.__cond.notify_all()
+	
+	def cancel(self):
+		with self.__cond:
+			self.__stopped = True
+			self.__cancelled = True
+			self.__cond.notify_all()
+	
+	def is_paused(self):
+		return self.__paused
+	
+	def is_stopped(self):
+		return self.__stopped
 	
+	def is_cancelled(self):
+		return self.__cancelled
+	
+	def wait_if_paused(self):
+		'''Blocks while the upload is paused. Returns False if the upload has been stopped, True otherwise.
+		'''
+		with self.__cond:
+			while self.__paused and not self.__stopped:
+				self.__cond.wait()
+			return not self.__stopped
+
+
+class RemoteCheckpoint:
+	'''Stands in for an UploadCheckpoint in the worker processes of a multi-process upload. Files are checked against the
+	checkpoint before they're handed to workers, and files uploaded by workers are sent to the coordinator to be added.
+	'''
+	def __init__(self, results):
+		self.__results = results
+	
+	def contains(self, pid, target_path, local_filepath):
+		return False
+	
+	def add(self, pid, target_path, local_filepath):
+		self.__results.put((MESSAGE_CHECKPOINT, pid, target_path, local_filepath))
+
+
+class VerifyResult:
 	def __init__(self):
-		__filename = "anudc.conf"
-		__file = open(os.path.join(os.path.dirname(__file__), __filename))
+		self.matched_count = 0
+		self.missing = []
+		self.mismatched = []
+		self.errors = []
+		# None if the files in the collection couldn't be listed.
+		self.extra = None
+
+
+class ConnectionPool:
+	def __init__(self, transport, max_idle=1):
+		self.__transport = transport
+		self.__max_idle = max_idle
+		self.__idle_conns = []
+		self.__lock = threading.Lock()
+	
+	def acquire(self):
+		with self.__lock:
+			if len(self.__idle_conns) > 0:
+				return self.__idle_conns.pop()
+		return self.__transport.create_connection()
+	
+	def release(self, conn):
+		with self.__lock:
+			if len(self.__idle_conns) < self.__max_idle:
+				self.__idle_conns.append(conn)
+				return
+		conn.close()
+	
+	def close_all(self):
+		with self.__lock:
+			for conn in self.__idle_conns:
+				conn.close()
+			self.__idle_conns = []
+
+
+class ConcurrencyLimiter:
+	'''Semaphore whose limit can be changed while it's in use. Lowering the limit doesn't interrupt holders, it only
+	delays new acquirers until the number of holders falls below the new limit.
+	'''
+	def __init__(self, limit):
+		self.__limit = max(1, limit)
+		self.__in_use = 0
+		self.__cond = threading.Condition()
+	
+	def acquire(self):
+		with self.__cond:
+			while self.__in_use >= self.__limit:
+				self.__cond.wait()
+			self.__in_use += 1
+	
+	def release(self):
+		with self.__cond:
+			self.__in_use -= 1
+			self.__cond.notify_all()
+	
+	def get_limit(self):
+		return self.__limit
+	
+	def get_in_use(self):
+		return self.__in_use
+	
+	def set_limit(self, limit):
+		with self.__cond:
+			self.__limit = max(1, limit)
+			self.__cond.notify_all()
+	
+	def __enter__(self):
+		self.acquire()
+		return self
+	
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.release()
+
+
+class AdaptiveConcurrency:
+	'''Adjusts the limit of a ConcurrencyLimiter to what the server can sustain, using additive increase and
+	multiplicative decrease. While the limiter is fully used and responses are prompt, the limit is raised by one after
+	each limit's worth of responses. It's halved when the server shows it's overloaded, with a 429, 502, 503 or 504
+	response, a connection error, or response times well above the lowest recently seen. After a decrease, there's no
+	further decrease until a limit's worth of responses has been received, so responses to requests sent before the
+	decrease don't reduce the limit again.
+	'''
+	def __init__(self, name, limiter, min_limit=1, max_limit=MAX_WORKERS):
+		self.__name = name
+		self.__limiter = limiter
+		self.__min_limit = min_limit
+		self.__max_limit = max_limit
+		self.__latency = None
+		self.__baseline_latency = None
+		self.__good_responses = 0
+		self.__responses_since_decrease = None
+		self.__transfers = collections.deque()
+		self.__counts = {"responses": 0, "overloads": 0, "increases": 0, "decreases": 0}
+		self.__lock = threading.Lock()
+	
+	def record(self, status, latency=None, num_bytes=0):
+		'''Records the status of a response, or None if the request failed, and optionally the number of seconds waited
+		for the response and the number of bytes it completed uploading.
+		'''
+		with self.__lock:
+			now = time.monotonic()
+			self.__counts["responses"] += 1
+			if num_bytes > 0:
+				self.__transfers.append((now, num_bytes))
+			
+			overloaded = status is None or status in RETRY_STATUSES
+			reason = "connection error" if status is None else str(status) + " response"
+			if latency is not None and status is not None:
+				if self.__latency is None:
+					self.__latency = latency
+					self.__baseline_latency = latency
+				else:
+					self.__latency += LATENCY_SMOOTHING * (latency - self.__latency)
+					self.__baseline_latency = min(latency, self.__baseline_latency * (1 + LATENCY_BASELINE_DRIFT))
+				if self.__latency > max(self.__baseline_latency * LATENCY_TOLERANCE, self.__baseline_latency + LATENCY_MIN_INCREASE_SEC):
+					overloaded = True
+					reason = "response time {:,.0f} ms".format(self.__latency * 1000)
+			
+			limit = self.__limiter.get_limit()
+			if self.__responses_since_decrease is not None:
+				self.__responses_since_decrease += 1
+			if overloaded:
+				self.__counts["overloads"] += 1
+				self.__good_responses = 0
+				if (self.__responses_since_decrease is None or self.__responses_since_decrease >= limit) and limit > self.__min_limit:
+					self.__set_limit(max(self.__min_limit, min(limit - 1, limit // 2)), reason)
+					self.__counts["decreases"] += 1
+					self.__responses_since_decrease = 0
+			elif self.__limiter.get_in_use() >= limit:
+				# Only raised when all of the current limit is in use, otherwise a higher limit wouldn't be used.
+				self.__good_responses += 1
+				if self.__good_responses >= limit and limit < self.__max_limit:
+					self.__set_limit(limit + 1, None)
+					self.__counts["increases"] += 1
+					self.__good_responses = 0
+	
+	def __set_limit(self, limit, reason):
+		if reason is not None:
+			logging.info(self.__name + " concurrency lowered from " + str(self.__limiter.get_limit()) + " to " + str(limit) + " because of " + reason)
+		else:
+			logging.debug(self.__name + " concurrency raised to " + str(limit))
+		self.__limiter.set_limit(limit)
+	
+	def get_metrics(self):
+		with self.__lock:
+			now = time.monotonic()
+			while len(self.__transfers) > 0 and now - self.__transfers[0][0] > THROUGHPUT_WINDOW_SEC:
+				self.__transfers.popleft()
+			metrics = dict(self.__counts)
+			metrics["limit"] = self.__limiter.get_limit()
+			metrics["in_use"] = self.__limiter.get_in_use()
+			metrics["latency_ms"] = round(self.__latency * 1000, 1) if self.__latency is not None else None
+			metrics["baseline_latency_ms"] = round(self.__baseline_latency * 1000, 1) if self.__baseline_latency is not None else None
+			metrics["throughput_kbps"] = round(sum(num_bytes for time_recorded, num_bytes in self.__transfers) / 1024 / THROUGHPUT_WINDOW_SEC, 1)
+		return metrics
+	
+	def format_metrics(self):
+		return format_concurrency_metrics(self.__name, self.get_metrics())
+
+
+def format_concurrency_metrics(name, metrics):
+	latency = "-" if metrics["latency_ms"] is None else "{:,.0f} ms (lowest {:,.0f} ms)".format(metrics["latency_ms"], metrics["baseline_latency_ms"])
+	return "{} concurrency: {} ({} raised, {} lowered, {} overload signals in {} responses), response time {}".format(
+		name, str(metrics["limit"]), str(metrics["increases"]), str(metrics["decreases"]), str(metrics["overloads"]), str(metrics["responses"]), latency)
+
+
+def combine_concurrency_metrics(metrics_list):
+	'''Combines the metrics of the AdaptiveConcurrency of several processes. Limits, counts and throughput are added up,
+	the response time is averaged over all responses and the lowest response time is the lowest of any process.
+	'''
+	combined = {"responses": 0, "overloads": 0, "increases": 0, "decreases": 0, "limit": 0, "in_use": 0, "throughput_kbps": 0}
+	for metrics in metrics_list:
+		for key in combined:
+			combined[key] += metrics[key]
+	
+	timed_metrics = [metrics for metrics in metrics_list if metrics["latency_ms"] is not None]
+	combined["latency_ms"] = None
+	combined["baseline_latency_ms"] = None
+	if len(timed_metrics) > 0:
+		# A process has a response time once it has recorded a response, so the total is never 0.
+		total_responses = sum(metrics["responses"] for metrics in timed_metrics)
+		combined["latency_ms"] = round(sum(metrics["latency_ms"] * metrics["responses"] for metrics in timed_metrics) / total_responses, 1)
+		combined["baseline_latency_ms"] = min(metrics["baseline_latency_ms"] for metrics in timed_metrics)
+	combined["throughput_kbps"] = round(combined["throughput_kbps"], 1)
+	return combined
+
+
+class BandwidthLimiter:
+	'''Token bucket shared by all upload workers. Workers call consume() with the number of bytes they've sent and are
+	delayed as needed to keep the total rate at or below the limit.
+	'''
+	def __init__(self, bytes_per_sec=0):
+		self.__rate = bytes_per_sec
+		self.__allowance = 0
+		self.__last_time = time.monotonic()
+		self.__lock = threading.Lock()
+	
+	def get_rate(self):
+		return self.__rate
+	
+	def set_rate(self, bytes_per_sec):
+		with self.__lock:
+			self.__rate = max(0, bytes_per_sec)
+			self.__allowance = 0
+			self.__last_time = time.monotonic()
+	
+	def consume(self, num_bytes):
+		with self.__lock:
+			if self.__rate <= 0:
+				return
+			now = time.monotonic()
+			# Allow bursts of up to one second's worth of data.
+			self.__allowance = min(self.__rate, self.__allowance + (now - self.__last_time) * self.__rate) - num_bytes
+			self.__last_time = now
+			delay = 0
+			if self.__allowance < 0:
+				delay = -self.__allowance / self.__rate
+		if delay > 0:
+			time.sleep(delay)
+
+
+class ChecksumCache:
+	'''Caches MD5 checksums of local files keyed on their absolute path. An entry is only used if the file's size and
+	modification time haven't changed since it was calculated. If a filename is provided, the cache is loaded from and
+	saved to that file so checksums survive between runs, and if a spool directory is also provided, the entries are kept
+	on disk in that directory instead of in memory. Without a filename, only the last CHECKSUM_CACHE_SIZE checksums are
+	kept.
+	'''
+	def __init__(self, filename=None, spool_dir=None):
+		self.__filename = filename
+		# Keys of entries that need to be saved, or None if there's no file to save them to.
+		if self.__filename is None:
+			self.__entries = collections.OrderedDict()
+			self.__updated_keys = None
+		elif spool_dir is not None:
+			self.__entries = SpoolDict(spool_dir)
+			self.__updated_keys = SpoolDict(spool_dir)
+		else:
+			self.__entries = {}
+			self.__updated_keys = {}
+		self.__modified = False
+		self.__lock = threading.Lock()
+		if self.__filename is not None and os.path.isfile(self.__filename):
+			self.__load()
+	
+	def __load(self):
+		with open(self.__filename, "r", encoding="utf-8") as fp:
+			# Format: md5<TAB>size<TAB>mtime_ns<TAB>path. Path is last as it's the only field that may contain tabs.
+			rows = (line.rstrip("\n").split("\t", 3) for line in fp)
+			self.__entries.update((fields[3], (int(fields[1]), int(fields[2]), fields[0])) for fields in rows if len(fields) == 4)
+	
+	def __put(self, key, entry):
+		self.__entries[key] = entry
+		if self.__updated_keys is not None:
+			self.__updated_keys[key] = True
+			self.__modified = True
+		else:
+			self.__entries.move_to_end(key)
+			if len(self.__entries) > CHECKSUM_CACHE_SIZE:
+				self.__entries.popitem(last=False)
+	
+	def get_md5(self, filepath, calc_md5):
+		'''Returns the MD5 of a file, calling calc_md5 with the file opened in binary mode if it isn't cached. The size and
+		modification time are those of the opened file before it's read, so a file changed while it's read is hashed
+		again next time.
+		'''
+		key = os.path.abspath(filepath)
+		with open(filepath, "rb") as fp:
+			stat = os.fstat(fp.fileno())
+			with self.__lock:
+				entry = self.__entries.get(key)
+			if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+				return entry[2]
+			
+			md5 = calc_md5(fp)
+		with self.__lock:
+			self.__put(key, (stat.st_size, stat.st_mtime_ns, md5))
+		return md5
+	
+	def pop_updates(self):
+		'''Returns the entries calculated since the cache was loaded or last popped, as a list of (path, entry) tuples,
+		and no longer treats them as needing to be saved.
+		'''
+		with self.__lock:
+			if self.__updated_keys is None:
+				return []
+			updates = [(key, self.__entries[key]) for key in self.__updated_keys]
+			self.__updated_keys.clear()
+			self.__modified = False
+		return updates
+	
+	def update(self, updates):
+		with self.__lock:
+			for key, entry in updates:
+				self.__put(key, entry)
+	
+	def save(self):
+		if self.__filename is None or not self.__modified:
+			return
+		with self.__lock:
+			temp_filename = self.__filename + ".tmp"
+			with open(temp_filename, "w", encoding="utf-8") as fp:
+				for path, (size, mtime_ns, md5) in self.__entries.items():
+					fp.write(md5 + "\t" + str(size) + "\t" + str(mtime_ns) + "\t" + path + "\n")
+			os.replace(temp_filename, self.__filename)
+			self.__modified = False
+	
+	def close(self):
+		if isinstance(self.__entries, SpoolDict):
+			self.__entries.close()
+			self.__updated_keys.close()
+
+
+
+class DeltaCache:
+	'''Keeps the MD5 and block digests of files last uploaded, keyed on their URL, so that when a file changes only the
+	blocks that differ from the copy on the server need to be sent. Entries are only used if the server still reports
+	the same MD5. Saved to filename so digests survive between runs.
+	'''
+	def __init__(self, filename):
+		self.__filename = filename
+		self.__entries = {}
+		self.__updated_keys = set()
+		self.__modified = False
+		self.__lock = threading.Lock()
+		if os.path.isfile(self.__filename):
+			with open(self.__filename, "r", encoding="utf-8") as fp:
+				for line in fp:
+					# Format: md5<TAB>block_size<TAB>comma separated block digests<TAB>url
+					fields = line.rstrip("\n").split("\t", 3)
+					if len(fields) == 4:
+						block_digests = fields[2].split(",") if fields[2] != "" else []
+						self.__entries[fields[3]] = (fields[0], int(fields[1]), block_digests)
+	
+	def get(self, key):
+		with self.__lock:
+			return self.__entries.get(key)
+	
+	def get_md5(self, key):
+		entry = self.get(key)
+		if entry is None:
+			return None
+		return entry[0]
+	
+	def put(self, key, md5, block_size, block_digests):
+		with self.__lock:
+			self.__entries[key] = (md5, block_size, list(block_digests))
+			self.__updated_keys.add(key)
+			self.__modified = True
+	
+	def pop_updates(self):
+		with self.__lock:
+			updates = [(key, self.__entries[key]) for key in self.__updated_keys]
+			self.__updated_keys = set()
+			self.__modified = False
+		return updates
+	
+	def update(self, updates):
+		with self.__lock:
+			for key, entry in updates:
+				self.__entries[key] = entry
+				self.__updated_keys.add(key)
+			if len(updates) > 0:
+				self.__modified = True
+	
+	def save(self):
+		if not self.__modified:
+			return
+		with self.__lock:
+			temp_filename = self.__filename + ".tmp"
+			with open(temp_filename, "w", encoding="utf-8") as fp:
+				for url, (md5, block_size, block_digests) in self.__entries.items():
+					fp.write(md5 + "\t" + str(block_size) + "\t" + ",".join(block_digests) + "\t" + url + "\n")
+			os.replace(temp_filename, self.__filename)
+			self.__modified = False
+
+	
+class AnudcServerConfig:
+	
+	def __init__(self, filename=None):
+		# Defaults to anudc.conf in the same directory as this file.
+		if filename is None:
+			filename = os.path.join(os.path.dirname(__file__), "anudc.conf")
+		__file = open(filename)
 		
 		self.__metadata_section = "datacommons"
 		
@@ -300,6 +1817,9 @@ class AnudcServerConfig:
 	def get_config_addlinkurl(self):
 		return self.get_config_value(self.__metadata_section, "addlink_url")
 	
+	def get_config_listfilesurl(self):
+		return self.get_config_value(self.__metadata_section, "listfiles_url")
+	
 	def get_config_token(self):
 		return self.get_config_value(self.__metadata_section, "token")
 
@@ -315,6 +1835,70 @@ class AnudcServerConfig:
 	def get_config_protocol(self):
 		return self.get_config_value(self.__metadata_section, "proto")
 	
+	def get_config_max_workers(self):
+		max_workers = self.get_config_value(self.__metadata_section, "max_workers")
+		if max_workers is None:
+			max_workers = 1
+		return max_workers
+	
+	def get_config_verify_workers(self):
+		verify_workers = self.get_config_value(self.__metadata_section, "verify_workers")
+		if verify_workers is None:
+			verify_workers = 8
+		return verify_workers
+	
+	def get_config_patchfileurl(self):
+		return self.get_config_value(self.__metadata_section, "patchfile_url")
+	
+	def get_config_delta_cache(self):
+		delta_cache = self.get_config_value(self.__metadata_section, "delta_cache")
+		if delta_cache is None:
+			delta_cache = os.path.join(os.path.expanduser("~"), ".anudc_delta_cache")
+		return delta_cache
+	
+	def get_config_delta_block_size(self):
+		block_size = self.get_config_value(self.__metadata_section, "delta_block_size")
+		if block_size is None:
+			block_size = 4 * 1024 * 1024
+		return block_size
+	
+	def get_config_processes(self):
+		processes = self.get_config_value(self.__metadata_section, "processes")
+		if processes is None:
+			processes = 1
+		return processes
+	
+	def get_config_scan_workers(self):
+		scan_workers = self.get_config_value(self.__metadata_section, "scan_workers")
+		if scan_workers is None:
+			scan_workers = 8
+		return scan_workers
+	
+	def get_config_download_workers(self):
+		download_workers = self.get_config_value(self.__metadata_section, "download_workers")
+		if download_workers is None:
+			download_workers = 4
+		return download_workers
+	
+	def get_config_download_segment_size(self):
+		segment_size = self.get_config_value(self.__metadata_section, "download_segment_size")
+		if segment_size is None:
+			segment_size = 64 * 1024 * 1024
+		return segment_size
+	
+	def get_config_adaptive_concurrency(self):
+		adaptive = self.get_config_value(self.__metadata_section, "adaptive_concurrency")
+		return adaptive is not None and adaptive.lower() in ("true", "yes", "1")
+	
+	def get_config_bandwidth_limit(self):
+		bandwidth_limit = self.get_config_value(self.__metadata_section, "bandwidth_limit")
+		if bandwidth_limit is None:
+			bandwidth_limit = 0
+		return bandwidth_limit
+	
+	def get_config_checksum_cache(self):
+		return self.get_config_value(self.__metadata_section, "checksum_cache")
+	
 	def get_config_inter_fileupload_delay(self):
 		delay = self.get_config_value(self.__metadata_section, "inter_fileupload_delay")
 		if delay is None:
@@ -322,6 +1906,14 @@ class AnudcServerConfig:
 		return delay
 	
 class MetadataFile:
+	'''Reads and updates a collection parameter file. The file is read in a single pass that only records where each
+	section starts; the key/value pairs of a section are parsed the first time the section is accessed. Parsed files are
+	cached, keyed on their path, size and modification time, so reading the same file again doesn't parse it again.
+	Files are read with the same rules as configparser, which was used to read them before.
+	'''
+	
+	__parsed_files = {}
+	__parsed_files_lock = threading.Lock()
 
 	def __init__(self, filename, delimiter="||"):
 		self.__filename = filename
@@ -331,84 +1923,366 @@ class MetadataFile:
 		self.__upload_files_section = "files"
 		self.__relations_section = "relations"
 		self.__template_section = "template"
+		self.__request_section = "request"
 		self.__delimiter = delimiter
 		
-		self.__config_parser = configparser.ConfigParser()
-#		self.__config_parser = configparser.ConfigParser(dict_type=MultiOrderedDict,strict=False)
-		self.__config_parser.optionxform = str
-		
-		try:
-			fp = self.__open_file("r", encoding='utf-8')
-			self.__config_parser.readfp(fp)
-		finally:
-			fp.close()
+		self.__load()
+		self.__validate()
 
 	def read_template(self):
-		try:
-			template = self.__config_parser.get(self.__template_section, "template")
-		except:
-			template = None
-		return template
+		return self.__get_value(self.__template_section, "template")
 		
 	
 	def read_metadata_list(self):
-		parsermetadata = self.__config_parser.items(self.__metadata_section)
-		
-		metadata = []
+		metadata = self.__split_values(self.__get_section(self.__metadata_section))
 		
-		for key, value in parsermetadata:
-			splitvals = value.split(sep=self.__delimiter)
-			for val in splitvals:
-				metadata.append((key,val))
-		
-		for key, value in metadata:
-			logging.debug(key + ": " + value)
+		if logging.getLogger().isEnabledFor(logging.DEBUG):
+			for key, value in metadata:
+				logging.debug(key + ": " + value)
 
 		return metadata
 	
 	
 	def read_upload_files_list(self):
-		try:
-			files_list = self.__config_parser.items(self.__upload_files_section)
-		except:
-			files_list = None
+		files_list = self.__get_section(self.__upload_files_section)
+		if files_list is not None:
+			for target_path, local_filepath in files_list:
+				if local_filepath == "":
+					raise Exception("Metadata file " + self.__filename + ": No local file or folder for " + target_path + " in section [" + self.__upload_files_section + "]")
+			files_list = list(files_list)
 		return files_list
 	
 	
 	def read_pid(self):
-		try:
-			pid = self.__config_parser.get(self.__pid_section, "pid")
-		except:
-			pid = None
-		return pid
+		return self.__get_value(self.__pid_section, "pid")
 	
 	
 	def write_pid(self, pid):
-		if not self.__config_parser.has_section(self.__pid_section):
-			self.__config_parser.add_section(self.__pid_section)
-			
-		self.__config_parser.set(self.__pid_section, "pid", pid)
-		try:
-			fp = self.__open_file("w")
-			self.__config_parser.write(fp)
-		finally:
-			fp.close()
+		self.__set_value(self.__pid_section, "pid", pid)
+	
+	
+	def read_request_key(self):
+		return self.__get_value(self.__request_section, "request_key")
+	
+	
+	def write_request_key(self, request_key):
+		self.__set_value(self.__request_section, "request_key", request_key)
 		
 		
 	def read_relations(self):
+		relations = self.__get_section(self.__relations_section)
+		if relations is not None:
+			relations = self.__split_values(relations)
+		return relations
+	
+	
+	def __split_values(self, items):
+		delimiter = self.__delimiter
+		return [(key, val) for key, value in items for val in value.split(delimiter)]
+	
+	
+	def __load(self):
+		stat = os.stat(self.__filename)
+		cache_key = os.path.abspath(self.__filename)
+		with MetadataFile.__parsed_files_lock:
+			parsed_file = MetadataFile.__parsed_files.get(cache_key)
+		if parsed_file is not None and parsed_file.size == stat.st_size and parsed_file.mtime_ns == stat.st_mtime_ns:
+			self.__parsed_file = parsed_file
+			return
+		
+		parsed_file = ParsedMetadataFile()
+		parsed_file.size = stat.st_size
+		parsed_file.mtime_ns = stat.st_mtime_ns
+		with open(self.__filename, "r", encoding="utf-8") as fp:
+			# Split on newlines only, as configparser does. splitlines would also split on other line breaks.
+			parsed_file.lines = fp.read().split("\n")
+		if parsed_file.lines[-1] == "":
+			parsed_file.lines.pop()
+		
+		# Only section headers are located here. Sections are parsed by __get_entries when they're first read. As in
+		# configparser, a line indented more than the key before it in the section continues that key's value, even if
+		# it looks like a section header.
+		parsed_file.section_ranges = {}
+		parsed_file.entries = {}
+		parsed_file.sections = {}
+		section = None
+		key_found = False
+		indent_level = 0
+		for line_index, line in enumerate(parsed_file.lines):
+			stripped = line.strip()
+			if stripped == "" or stripped[0] in ("#", ";"):
+				continue
+			indent = len(line) - len(line.lstrip())
+			if key_found and indent > indent_level:
+				continue
+			indent_level = indent
+			header_end = stripped.rfind("]")
+			if stripped[0] == "[" and header_end > 1:
+				if section is not None:
+					parsed_file.section_ranges[section].append((section_start, line_index))
+				section = stripped[1:header_end]
+				# As in configparser, [DEFAULT] may appear more than once.
+				if section in parsed_file.section_ranges and section != DEFAULT_SECTION:
+					raise Exception(self.__error(line_index, "Duplicate section [" + section + "]"))
+				parsed_file.section_ranges.setdefault(section, [])
+				section_start = line_index + 1
+				key_found = False
+			elif section is None:
+				raise Exception(self.__error(line_index, "Line is not in a section"))
+			elif ("=" not in stripped and ":" not in stripped) or stripped[0] in ("=", ":"):
+				raise Exception(self.__error(line_index, "Expected key = value"))
+			else:
+				key_found = True
+		if section is not None:
+			parsed_file.section_ranges[section].append((section_start, len(parsed_file.lines)))
+		
+		self.__parsed_file = parsed_file
+		with MetadataFile.__parsed_files_lock:
+			MetadataFile.__parsed_files[cache_key] = parsed_file
+			if len(MetadataFile.__parsed_files) > METADATA_CACHE_SIZE:
+				del MetadataFile.__parsed_files[next(iter(MetadataFile.__parsed_files))]
+	
+	
+	def __validate(self):
+		# The [files] section can be very large so it's only parsed when it's read. All other sections are parsed here so
+		# errors in them are found before a record is created.
+		section_ranges = self.__parsed_file.section_ranges
+		for section in section_ranges:
+			if section != self.__upload_files_section:
+				self.__get_entries(section)
+		for section in (self.__metadata_section, self.__pid_section, self.__relations_section, self.__template_section, self.__request_section):
+			self.__get_section(section)
+		
+		if self.__metadata_section not in section_ranges and self.read_pid() is None:
+			raise Exception("Metadata file " + self.__filename + " must contain a [" + self.__metadata_section + "] section or a PID in a [" + self.__pid_section + "] section.")
+		
+		for key, value in self.__get_section(self.__relations_section) or []:
+			if value == "":
+				raise Exception("Metadata file " + self.__filename + ": No related PID for " + key + " in section [" + self.__relations_section + "]")
+		
+		for section in section_ranges:
+			if section not in (DEFAULT_SECTION, self.__metadata_section, self.__pid_section, self.__upload_files_section, self.__relations_section, self.__template_section, self.__request_section):
+				logging.warning("Metadata file " + self.__filename + ": Ignoring unknown section [" + section + "]")
+	
+	
+	def __get_section(self, section):
+		'''Returns the list of (key, value) tuples in a section, or None if the section doesn't exist. As in configparser,
+		keys in [DEFAULT] are included in every section, and values are interpolated: %% is replaced by % and %(key)s by
+		the value of key in the section or in [DEFAULT].
+		'''
+		parsed_file = self.__parsed_file
+		items = parsed_file.sections.get(section)
+		if items is not None or section not in parsed_file.section_ranges or section == DEFAULT_SECTION:
+			return items
+		
+		# Keys in [DEFAULT] come first, followed by the keys only in this section.
+		entries = dict(self.__get_entries(DEFAULT_SECTION))
+		entries.update(self.__get_entries(section))
+		values = dict((key, value) for key, (value, first_line_index, last_line_index) in entries.items())
+		items = []
+		for key, (value, first_line_index, last_line_index) in entries.items():
+			if "%" in value:
+				value = self.__interpolate(value, values, first_line_index, 1)
+			items.append((key, value))
+		
+		parsed_file.sections[section] = items
+		return items
+	
+	
+	def __get_entries(self, section):
+		'''Returns the keys in a section, without interpolation or keys from [DEFAULT], as a dict of tuples of the raw value
+		and the indexes of the first and last lines of the key's value. Values spanning multiple lines are continued on
+		lines indented more than the key. As in configparser, blank lines within a value are kept.
+		'''
+		parsed_file = self.__parsed_file
+		entries = parsed_file.entries.get(section)
+		if entries is not None:
+			return entries
+		
+		entries = {}
+		for start, end in parsed_file.section_ranges.get(section, []):
+			key = None
+			for line_index in range(start, end):
+				line = parsed_file.lines[line_index]
+				stripped = line.strip()
+				if stripped == "":
+					if key is not None:
+						value_lines.append("")
+					continue
+				if stripped[0] in ("#", ";"):
+					continue
+				indent = len(line) - len(line.lstrip())
+				if key is not None and indent > indent_level:
+					value_lines.append(stripped)
+					last_line_index = line_index
+					continue
+				
+				if key is not None:
+					entries[key] = ("\n".join(value_lines).rstrip(), first_line_index, last_line_index)
+				indent_level = indent
+				# As in configparser, the key ends at the first '=' or ':'.
+				equals_index = stripped.find("=")
+				colon_index = stripped.find(":")
+				if equals_index < 0 or (0 <= colon_index < equals_index):
+					equals_index = colon_index
+				key = stripped[:equals_index].rstrip()
+				if key in entries:
+					raise Exception(self.__error(line_index, "Duplicate key " + key + " in section [" + section + "]"))
+				value_lines = [stripped[equals_index + 1:].strip()]
+				first_line_index = line_index
+				last_line_index = line_index
+			if key is not None:
+				entries[key] = ("\n".join(value_lines).rstrip(), first_line_index, last_line_index)
+		
+		parsed_file.entries[section] = entries
+		return entries
+	
+	
+	def __interpolate(self, value, values, line_index, depth):
+		'''Interpolates a value as configparser's BasicInterpolation does.
+		'''
+		if depth > configparser.MAX_INTERPOLATION_DEPTH:
+			raise Exception(self.__error(line_index, "Value refers to other keys more than " + str(configparser.MAX_INTERPOLATION_DEPTH) + " levels deep"))
+		parts = []
+		rest = value
+		while rest:
+			percent_index = rest.find("%")
+			if percent_index < 0:
+				parts.append(rest)
+				break
+			parts.append(rest[:percent_index])
+			rest = rest[percent_index:]
+			if rest[1:2] == "%":
+				parts.append("%")
+				rest = rest[2:]
+			elif rest[1:2] == "(":
+				match = INTERPOLATION_KEY_RE.match(rest)
+				if match is None:
+					raise Exception(self.__error(line_index, "Bad reference to another key in " + rest))
+				referenced_key = match.group(1)
+				if referenced_key not in values:
+					raise Exception(self.__error(line_index, "Value refers to " + referenced_key + ", which isn't in the same section or in [" + DEFAULT_SECTION + "]"))
+				referenced_value = values[referenced_key]
+				if "%" in referenced_value:
+					referenced_value = self.__interpolate(referenced_value, values, line_index, depth + 1)
+				parts.append(referenced_value)
+				rest = rest[match.end():]
+			else:
+				raise Exception(self.__error(line_index, "'%' must be followed by '%' or '(', found " + rest + ". Use %% for a literal %."))
+		return "".join(parts)
+	
+	
+	def __get_value(self, section, key):
+		for item_key, value in self.__get_section(section) or []:
+			if item_key == key:
+				return value
+		return None
+	
+	
+	def __set_value(self, section, key, value):
+		'''Sets a value in the file, leaving the rest of the file as it is. The file is written to a temporary file which
+		then replaces the original, so the original is never left partially written.
+		'''
+		lines = list(self.__parsed_file.lines)
+		# Escaped so the value is read back unchanged.
+		new_line = key + " = " + value.replace("%", "%%")
+		section_ranges = self.__parsed_file.section_ranges.get(section)
+		if section_ranges is None:
+			if len(lines) > 0 and lines[-1].strip() != "":
+				lines.append("")
+			lines.append("[" + section + "]")
+			lines.append(new_line)
+		else:
+			entry = self.__get_entries(section).get(key)
+			if entry is not None:
+				old_value, first_line_index, last_line_index = entry
+				lines[first_line_index:last_line_index + 1] = [new_line]
+			else:
+				# Insert after the last non blank line in the section.
+				start, end = section_ranges[0]
+				insert_index = end
+				while insert_index > start and lines[insert_index - 1].strip() == "":
+					insert_index -= 1
+				lines.insert(insert_index, new_line)
+		
+		directory = os.path.dirname(os.path.abspath(self.__filename))
+		fd, temp_filename = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
 		try:
-			relations = []
-			relationsmetadata = self.__config_parser.items(self.__relations_section)
-			for key, value in relationsmetadata:
-				splitvals = value.split(sep=self.__delimiter)
-				for val in splitvals:
-					relations.append((key,val))
+			with os.fdopen(fd, "w", encoding="utf-8") as fp:
+				fp.write("\n".join(lines) + "\n")
+				fp.flush()
+				os.fsync(fp.fileno())
+			shutil.copymode(self.__filename, temp_filename)
+			os.replace(temp_filename, self.__filename)
 		except:
-			relations = None
+			if os.path.isfile(temp_filename):
+				os.remove(temp_filename)
+			raise
 		
-		return relations
+		with MetadataFile.__parsed_files_lock:
+			MetadataFile.__parsed_files.pop(os.path.abspath(self.__filename), None)
+		self.__load()
+	
+	
+	def __error(self, line_index, message):
+		return "Metadata file " + self.__filename + ", line " + str(line_index + 1) + ": " + message
+
+
+class ParsedMetadataFile:
+	pass
+
+
+class JobFile:
+	'''Reads a batch job specification. Each section in the file is a job that uploads files to a single collection
+	identified either by a PID or by a metadata file, e.g.
+	
+		[collection1]
+		pid = anudc:123
+		files = ~/dir1||~/dir2/
+		
+		[collection2]
+		metadata_file = ~/collection2.txt
+		server_dir = /raw
+	'''
+	
+	def __init__(self, filename, delimiter="||"):
+		self.__filename = filename
+		self.__delimiter = delimiter
 		
+		self.__config_parser = configparser.ConfigParser()
+		self.__config_parser.optionxform = str
+		
+		fp = open(self.__filename, "r", encoding="utf-8")
+		try:
+			self.__config_parser.read_file(fp)
+		finally:
+			fp.close()
+	
+	
+	def read_jobs(self):
+		jobs = []
+		base_dir = os.path.dirname(os.path.abspath(self.__filename))
+		for section in self.__config_parser.sections():
+			job = Job()
+			job.name = section
+			job.pid = self.__config_parser.get(section, "pid", fallback=None)
+			job.metadata_file = self.__config_parser.get(section, "metadata_file", fallback=None)
+			job.server_dir = self.__config_parser.get(section, "server_dir", fallback="/")
+			job.files = []
+			files = self.__config_parser.get(section, "files", fallback=None)
+			if files is not None:
+				job.files = [os.path.join(base_dir, os.path.expanduser(f.strip())) for f in files.split(sep=self.__delimiter) if f.strip() != ""]
+			
+			if job.pid is None and job.metadata_file is None:
+				raise Exception("Job " + section + " in " + self.__filename + " must specify a pid or a metadata_file.")
+			
+			# Relative paths are relative to the job file.
+			if job.metadata_file is not None:
+				job.metadata_file = os.path.join(base_dir, os.path.expanduser(job.metadata_file))
+			jobs.append(job)
 		
-	def __open_file(self, mode, encoding='utf-8'):
-		fp = open(self.__filename, mode)
-		return fp
+		return jobs
+
+
+class Job:
+	pass
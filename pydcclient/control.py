@@ -0,0 +1,142 @@
+'''
+Australian National University Data Commons
+Copyright (C) 2013  The Australian National University
+
+This file is part of Australian National University Data Commons.
+
+Australian National University Data Commons is free software: you
+can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Rahul Khanna <rahul.khanna@anu.edu.au>
+'''
+
+import logging
+import os
+import socket
+import stat
+import threading
+
+
+VERSION = "0.1-20261019"
+LOGGER_NAME = "ControlServer"
+
+
+class ControlServer:
+	'''Accepts commands on a local Unix socket to control an upload while it's running. Each line received is a command,
+	and a single line response starting with OK or ERROR is sent back for each. Commands:
+	
+		status           Displays the state of the upload, and adaptive concurrency metrics if enabled
+		pause            Stops starting new files until resumed
+		resume           Resumes a paused upload
+		stop             Lets files being uploaded finish, then stops
+		cancel           Aborts files being uploaded and stops
+		workers N        Changes the number of files uploaded concurrently
+		bwlimit KBPS     Changes the total upload rate limit in KB/s, 0 for no limit
+	'''
+	
+	def __init__(self, path, anudc, control):
+		self.__logger = logging.getLogger(LOGGER_NAME)
+		self.__path = path
+		self.__anudc = anudc
+		self.__control = control
+		self.__socket = None
+	
+	
+	def start(self):
+		if not hasattr(socket, "AF_UNIX"):
+			raise Exception("Control sockets aren't supported on this platform.")
+		# Only a socket left behind by a previous run is replaced, so a mistyped path can't delete some other file.
+		if os.path.lexists(self.__path):
+			if not stat.S_ISSOCK(os.lstat(self.__path).st_mode):
+				raise Exception("Unable to use " + self.__path + " as a control socket as it exists and isn't a socket.")
+			os.remove(self.__path)
+		self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.__socket.bind(self.__path)
+		os.chmod(self.__path, 0o600)
+		self.__socket.listen(1)
+		threading.Thread(target=self.__accept_connections, daemon=True).start()
+		self.__logger.info("Listening for commands on " + self.__path)
+	
+	
+	def stop(self):
+		if self.__socket is not None:
+			self.__socket.close()
+			self.__socket = None
+			if os.path.exists(self.__path):
+				os.remove(self.__path)
+	
+	
+	def __accept_connections(self):
+		while True:
+			try:
+				conn, address = self.__socket.accept()
+			except OSError:
+				# Socket closed by stop()
+				return
+			threading.Thread(target=self.__handle_connection, args=(conn,), daemon=True).start()
+	
+	
+	def __handle_connection(self, conn):
+		try:
+			with conn, conn.makefile("rw", encoding="utf-8", newline="\n") as fp:
+				for line in fp:
+					if line.strip() == "":
+						continue
+					fp.write(self.__process_command(line.split()) + "\n")
+					fp.flush()
+		except OSError as e:
+			self.__logger.warning("Control connection error: " + str(e))
+	
+	
+	def __process_command(self, args):
+		command = args[0].lower()
+		try:
+			if command == "status":
+				pass
+			elif command == "pause":
+				self.__control.pause()
+			elif command == "resume":
+				self.__control.resume()
+			elif command == "stop":
+				self.__control.stop()
+			elif command == "cancel":
+				self.__control.cancel()
+			elif command == "workers" and len(args) == 2:
+				self.__anudc.set_max_workers(int(args[1]))
+			elif command == "bwlimit" and len(args) == 2:
+				self.__anudc.set_bandwidth_limit(int(float(args[1]) * 1024))
+			else:
+				return "ERROR Unknown command: " + " ".join(args)
+		except Exception as e:
+			return "ERROR " + str(e)
+		
+		self.__logger.info("Control command: " + " ".join(args))
+		return "OK " + self.__status()
+	
+	
+	def __status(self):
+		if self.__control.is_cancelled():
+			state = "cancelled"
+		elif self.__control.is_stopped():
+			state = "stopping"
+		elif self.__control.is_paused():
+			state = "paused"
+		else:
+			state = "running"
+		status = "state={} workers={} bwlimit={}".format(state, str(self.__anudc.get_max_workers()), str(self.__anudc.get_bandwidth_limit() // 1024))
+		concurrency_metrics = self.__anudc.get_concurrency_metrics()
+		if concurrency_metrics is not None:
+			for name, metrics in sorted(concurrency_metrics.items()):
+				status += "".join(" {}_{}={}".format(name, key, str(value)) for key, value in sorted(metrics.items()))
+		return status
@@ -22,9 +22,15 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 import argparse
+import concurrent.futures
+import contextlib
 import os.path
 import logging
+import queue
+import signal
 import sys
+import threading
+import time
 import tkinter
 import tkinter.filedialog
 import tkinter.messagebox
@@ -32,11 +38,27 @@ from urllib.error import HTTPError
 
 from anudclib import MetadataFile
 from anudclib import AnudcClient
+from anudclib import AnudcServerConfig
+from anudclib import JobFile
+from anudclib import UploadControl
+from anudclib import EVENT_FILE_STARTED, EVENT_FILE_PROGRESS, EVENT_FILE_FINISHED
+from control import ControlServer
+from profiler import SamplingProfiler
+from scan import FileScanner
+from spool import UploadQueue
+from spool import UploadStatusLog
+from spool import UploadCheckpoint
+from transport import FakeServer
+from transport import FakeTransport
 from updater import Updater
 
 
 VERSION = "0.1-20180907"
 MANIFEST_URL = "https://raw.github.com/anu-doi/PyAnuDataCommons/master/pydcclient/manifest.properties"
+PROGRESS_POLL_INTERVAL_MS = 200
+
+EVENT_UPLOAD_FINISHED = "upload_finished"
+EVENT_UPLOAD_FAILED = "upload_failed"
 
 
 def init_cmd_parser():
@@ -45,6 +67,20 @@ def init_cmd_parser():
 	parser.add_argument("-c", "--createnew", dest="metadata_file", help="File containing metadata used to create a new Collection record.")
 	parser.add_argument("-p", "--pid", dest="pid", help="Identifier of an existing Collection Record on which actions are to be performed.")
 	parser.add_argument("files", nargs="*", help="File(s) to upload")
+	parser.add_argument("-j", "--jobfile", dest="job_file", help="File containing a list of jobs, each uploading files to a Collection, to be run in a single process.")
+	parser.add_argument("-w", "--workers", dest="max_workers", type=int, help="Maximum number of files uploaded concurrently across all jobs.")
+	parser.add_argument("--adaptive", dest="adaptive", action="store_const", const=True, help="Adjust the number of files uploaded concurrently to what the server can sustain, starting from --workers. The default is set by adaptive_concurrency in anudc.conf.")
+	parser.add_argument("--delta", dest="delta", action="store_true", help="When a file has changed since it was last uploaded, only send the parts that changed. Requires patchfile_url in anudc.conf.")
+	parser.add_argument("--processes", dest="processes", type=int, help="Number of processes to upload files with. Each process uploads up to the number of files set by --workers concurrently.")
+	parser.add_argument("--verify", action="store_true", help="Compare the files to upload with the files in the Collection without uploading anything.")
+	parser.add_argument("-d", "--download", dest="download_dir", help="Download the files in the Collection to this directory.")
+	parser.add_argument("--include", dest="include_patterns", action="append", help="Only download files whose path in the Collection matches this glob pattern, e.g. '/raw/*.csv'. May be repeated.")
+	parser.add_argument("--checkpoint", dest="checkpoint_file", help="File recording uploaded files. Files recorded as uploaded are skipped if the upload is run again, e.g. after being stopped.")
+	parser.add_argument("--bwlimit", dest="bandwidth_limit", type=float, help="Limit the total upload rate to this many KB/s.")
+	parser.add_argument("--control-socket", dest="control_socket", help="Accept commands to pause, resume or stop the upload, or change the number of workers or the bandwidth limit, on this Unix socket.")
+	parser.add_argument("--fake-server", dest="fake_server", nargs="?", const="", metavar="SPEC", help="Upload to a simulated server in memory instead of the server in anudc.conf, for load testing. SPEC is an optional comma separated list of latency (ms), throughput (KB/s), failure_rate (0 to 1), capacity (concurrent requests) and seed, e.g. latency=20,throughput=10240,failure_rate=0.01")
+	parser.add_argument("--profile", dest="profile_file", help="Profile the run, writing stack samples in folded format to this file for flame graph tools, and displaying the functions taking the most time on exit.")
+	parser.add_argument("--spool-dir", dest="spool_dir", help="Keep the list of files to upload and their upload statuses in files in this directory instead of in memory. Use when uploading very large numbers of files.")
 	parser.add_argument("--gui", action="store_true", help="Start GUI interface")
 	parser.add_argument("-v", "--version", action='version', version="ANU Data Uploader " + VERSION)
 
@@ -64,9 +100,9 @@ def check_file_exists(filename):
 	return os.path.isfile(filename)
 
 
-def display_summary(pid, file_status):
+def display_summary(pid, file_status, title="UPLOAD SUMMARY"):
 	print()
-	print("UPLOAD SUMMARY -", pid)
+	print(title, "-", pid)
 	print("---------------------------")
 	i = 0
 	success_count = 0;
@@ -88,6 +124,52 @@ def display_summary(pid, file_status):
 	print("{} successful. {} failed.".format(str(success_count), str(failed_count)))
 
 
+def display_verify_summary(pid, result):
+	print()
+	print("VERIFY SUMMARY -", pid)
+	print("---------------------------")
+	for target_path in sorted(result.missing):
+		print("{:>10} : {}".format("MISSING", target_path))
+	for target_path in sorted(result.mismatched):
+		print("{:>10} : {}".format("MISMATCHED", target_path))
+	for target_path, error in sorted(result.errors):
+		print("{:>10} : {} ({})".format("ERROR", target_path, error))
+	if result.extra is not None:
+		for target_path in result.extra:
+			print("{:>10} : {}".format("EXTRA", target_path))
+
+	print("{} matched. {} missing. {} mismatched. {} could not be checked.".format(str(result.matched_count), str(len(result.missing)), str(len(result.mismatched)), str(len(result.errors))))
+	if result.extra is not None:
+		print("{} extra file(s) in collection.".format(str(len(result.extra))))
+	else:
+		print("Extra files not checked as listfiles_url is not configured.")
+
+
+def kbps(num_bytes, seconds):
+	if seconds <= 0:
+		return 0
+	return (num_bytes / 1024) / seconds
+
+
+def create_fake_transport(anudc_config, spec):
+	params = {"latency": 0, "throughput": 0, "failure_rate": 0, "capacity": 0, "seed": None}
+	for param in spec.split(","):
+		if param.strip() == "":
+			continue
+		key, value = param.split("=", 1)
+		key = key.strip()
+		if key not in params:
+			raise Exception("Unknown fake server parameter " + key)
+		params[key] = float(value)
+	seed = int(params["seed"]) if params["seed"] is not None else None
+	return FakeTransport(FakeServer(anudc_config, latency=params["latency"] / 1000, throughput=params["throughput"] * 1024, failure_rate=params["failure_rate"], capacity=int(params["capacity"]), seed=seed))
+
+
+def display_fake_server_stats(server):
+	stats = server.get_stats()
+	print("Fake server: {requests} requests, {failures} failed, {connections} connections, {bytes_received:,} bytes received, {bytes_sent:,} bytes sent".format(**stats))
+
+
 def update():
 	try:
 		updater = Updater(manifest_url=MANIFEST_URL, base_dir=os.path.dirname(os.path.abspath(__file__)))
@@ -100,30 +182,34 @@ def normalise_path_separators(path):
 	return path.replace("\\", "/")
 
 
-def list_files_in_dir(rootpath):
+def list_files_in_dir(rootpath, scanner=None):
 	'''Lists files in the specified directory and all its subdirectories. If the specified path is a file, then the specified path itself is returned.
 	'''
 
-	filepath_list = []
-
-	if os.path.isdir(rootpath):
-		# Must have topdown=True as we're modifying dirs in place to exclude those whose names start with '.'
-		for root, dirs, files in os.walk(rootpath, topdown=True):
-			dirs[:] = [d for d in dirs if not d[0] == '.']
-			files = [f for f in files if not f[0] == '.']
-			for file in files:
-				filepath = os.path.join(root, file)
-				filepath_list.append(normalise_path_separators(filepath))
-	elif os.path.isfile(rootpath):
-		filepath_list.append(normalise_path_separators(rootpath))
+	return list(iter_files_in_dir(rootpath, scanner))
+
+
+def iter_files_in_dir(rootpath, scanner=None):
+	'''Same as list_files_in_dir, but yields filepaths as they're found instead of building a list. Directories are read
+	using the FileScanner provided, which caches the stat of each file found.
+	'''
+	if scanner is None:
+		scanner = FileScanner()
+
+	if scanner.get_stat_cache().isdir(rootpath):
+		for filepath in scanner.walk(rootpath):
+			yield normalise_path_separators(filepath)
+	elif scanner.get_stat_cache().isfile(rootpath):
+		yield normalise_path_separators(rootpath)
 	else:
 		print("WARNING: File or folder {} doesn't exist.".format(rootpath))
 
-	return filepath_list
-
 
-def create_uploadables(server_dir, local_filepath_list):
-	uploadable_list = {}
+def create_uploadables(server_dir, local_filepath_list, uploadable_list=None, scanner=None, control=None):
+	if uploadable_list is None:
+		uploadable_list = {}
+	if scanner is None:
+		scanner = FileScanner()
 	
 	# Normalise server_dir - prefix and suffix with '/'. If empty string, change to "/"
 	if server_dir == "":
@@ -135,11 +221,12 @@ def create_uploadables(server_dir, local_filepath_list):
 	
 	if local_filepath_list != None:
 		for local_filepath in local_filepath_list:
-			local_files = list_files_in_dir(local_filepath)
-			for local_file in local_files:
-				if os.path.isfile(local_filepath):
+			is_file = scanner.get_stat_cache().isfile(local_filepath)
+			for local_file in iter_files_in_dir(local_filepath, scanner):
+				raise_if_stopped(control)
+				if is_file:
 					uploadable_list[server_dir + os.path.basename(local_file)] = local_file
-				elif os.path.isdir(local_filepath):
+				else:
 					server_rel_path = os.path.relpath(local_file, os.path.dirname(local_filepath))
 					server_rel_path = normalise_path_separators(server_rel_path)
 					uploadable_list[server_dir + server_rel_path] = local_file
@@ -150,86 +237,306 @@ def main():
 	print()
 	cmd_params = init_cmd_parser()
 	init_logging()
+	
+	if cmd_params.profile_file != None:
+		profiler = SamplingProfiler()
+		profiler.start()
+		try:
+			run(cmd_params)
+		finally:
+			profiler.stop()
+			profiler.write_folded(cmd_params.profile_file)
+			profiler.print_summary()
+			print("Profile samples saved to " + cmd_params.profile_file)
+	else:
+		run(cmd_params)
+
 
+def run(cmd_params):
 	update()
 
-	anudc = AnudcClient()
+	anudc_config = AnudcServerConfig()
+	transport = None
+	if cmd_params.fake_server != None:
+		transport = create_fake_transport(anudc_config, cmd_params.fake_server)
 	
-	if cmd_params.gui:
-		UploadWindow(anudc=anudc, cmd_params=cmd_params).mainloop()
-	else:
-		CommandLineManager(anudc=anudc, cmd_params=cmd_params).process()
+	# Uploads controlled through a control socket always use the worker pool so the number of workers can be changed.
+	anudc = AnudcClient(anudc_config, max_workers=cmd_params.max_workers, sequential=False if cmd_params.control_socket != None else None, processes=cmd_params.processes, transport=transport, delta=cmd_params.delta, adaptive=cmd_params.adaptive, spool_dir=cmd_params.spool_dir)
+	if cmd_params.bandwidth_limit != None:
+		anudc.set_bandwidth_limit(int(cmd_params.bandwidth_limit * 1024))
+	
+	control = UploadControl()
+	checkpoint = None
+	control_server = None
+	try:
+		if cmd_params.gui:
+			UploadWindow(anudc=anudc, cmd_params=cmd_params).mainloop()
+		else:
+			install_signal_handlers(control)
+			if cmd_params.checkpoint_file != None:
+				checkpoint = UploadCheckpoint(cmd_params.checkpoint_file, anudc.get_file_scanner().get_stat_cache().stat, cmd_params.spool_dir)
+			if cmd_params.control_socket != None:
+				control_server = ControlServer(cmd_params.control_socket, anudc, control)
+				control_server.start()
+			
+			if cmd_params.job_file != None:
+				BatchManager(anudc=anudc, cmd_params=cmd_params, max_workers=anudc.get_max_workers(), control=control, checkpoint=checkpoint).process()
+			else:
+				CommandLineManager(anudc=anudc, cmd_params=cmd_params, control=control, checkpoint=checkpoint).process()
+			
+			if control.is_stopped():
+				print("Stopped before all files were processed. Run again to continue.")
+	finally:
+		if control_server is not None:
+			control_server.stop()
+		if checkpoint is not None:
+			checkpoint.close()
+		anudc.close()
+		if transport is not None:
+			display_fake_server_stats(transport.get_server())
+
+
+def install_signal_handlers(control):
+	'''Where supported, SIGUSR1 pauses transferring new files and SIGUSR2 resumes.
+	'''
+	def pause(signum, frame):
+		write_signal_message("Pausing. Files being uploaded will complete.")
+		control.pause()
+	
+	def resume(signum, frame):
+		write_signal_message("Resuming.")
+		control.resume()
+	
+	if hasattr(signal, "SIGUSR1"):
+		signal.signal(signal.SIGUSR1, pause)
+		signal.signal(signal.SIGUSR2, resume)
+
+
+@contextlib.contextmanager
+def stop_on_signals(control):
+	'''While in effect, SIGINT and SIGTERM let files being transferred finish, then stop. A second SIGINT or SIGTERM also
+	aborts files being transferred. Otherwise SIGINT raises KeyboardInterrupt and SIGTERM exits as usual, so listing files
+	and creating records can be interrupted straight away. Must be used from the main thread.
+	'''
+	def stop(signum, frame):
+		if control.is_stopped():
+			write_signal_message("Cancelling files in progress.")
+			control.cancel()
+		else:
+			write_signal_message("Stopping once files in progress are complete. Interrupt again to cancel them.")
+			control.stop()
+	
+	previous_handlers = [(signum, signal.signal(signum, stop)) for signum in (signal.SIGINT, signal.SIGTERM)]
+	try:
+		yield
+	finally:
+		for signum, handler in previous_handlers:
+			signal.signal(signum, handler)
+
+
+def write_signal_message(message):
+	'''Writes a message from a signal handler straight to stderr. Signal handlers run between bytecodes of the main
+	thread, and printing while the main thread is printing raises RuntimeError: reentrant call.
+	'''
+	try:
+		os.write(2, (message + "\n").encode("utf-8"))
+	except OSError:
+		pass
+
+
+def raise_if_stopped(control):
+	if control is not None and control.is_stopped():
+		raise Exception("Stopped before all files were listed.")
 		
 		
+def create_upload_containers(spool_dir=None, with_statuses=True):
+	'''Returns empty containers for the files to upload and their upload statuses. If a spool directory is specified,
+	both are kept on disk in that directory so that memory use stays flat regardless of the number of files.
+	'''
+	file_status = None
+	if spool_dir is None:
+		files_to_upload = {}
+		if with_statuses:
+			file_status = {}
+	else:
+		files_to_upload = UploadQueue(spool_dir)
+		if with_statuses:
+			file_status = UploadStatusLog(spool_dir)
+	return files_to_upload, file_status
+
+
+def close_upload_containers(files_to_upload, file_status):
+	if isinstance(files_to_upload, UploadQueue):
+		files_to_upload.close()
+	if isinstance(file_status, UploadStatusLog):
+		file_status.close()
+		print("Upload statuses saved to " + file_status.get_filename())
+
+
+def plan_upload(anudc, metadata_file=None, pid=None, files=None, server_dir="/", files_to_upload=None, create=True, control=None):
+	'''Creates the record described in metadata_file if it doesn't have a PID yet and returns the PID along with a dict
+	of files to upload keyed on their target path in the collection. If files_to_upload is provided, files are added to
+	it instead of a new dict. If create is False, the record is never created. If an UploadControl is provided and is
+	stopped, an exception is raised instead of continuing to list files.
+	'''
+	if files_to_upload is None:
+		files_to_upload = {}
+
+	# If a metadata file has been provided, then create the record from the data. If
+	# it doesn't exist and read files to upload from it.
+	if metadata_file != None:
+		if not check_file_exists(metadata_file):
+			raise Exception("Metadata file " + metadata_file + " doesn't exist.")
+
+		metadatafile = MetadataFile(metadata_file)
+		metadata_pid = metadatafile.read_pid()
+
+		# Create record if PID doesn't already exist in the metadata file. Else, read the PID to upload files to it.
+		if metadata_pid == None and create:
+			raise_if_stopped(control)
+			metadata_pid = anudc.create_record(metadatafile)
+			metadatafile.write_pid(metadata_pid)
+
+			# Create relations
+			relation_statuses = anudc.create_relations(metadata_pid, metadatafile.read_relations())
+			for (link_type, related_pid), status in relation_statuses.items():
+				if status != 1:
+					print("WARNING: Unable to create relation {} {} for {}.".format(link_type, related_pid, metadata_pid))
+		if metadata_pid != None:
+			pid = metadata_pid
+
+		# Add list of files to upload if any in the metadata file.
+		metadata_file_list = metadatafile.read_upload_files_list()
+		if metadata_file_list != None:
+			scanner = anudc.get_file_scanner()
+			for target_rel_path, uploadable in metadata_file_list:
+				is_file = scanner.get_stat_cache().isfile(uploadable)
+				for local_filepath in iter_files_in_dir(uploadable, scanner):
+					raise_if_stopped(control)
+					if is_file:
+						files_to_upload[target_rel_path] = local_filepath
+					else:
+						relpath = target_rel_path
+						if relpath[-1:] != "/":
+							relpath += "/"
+						relpath += normalise_path_separators(os.path.relpath(local_filepath, os.path.dirname(uploadable)))
+						files_to_upload[relpath] = local_filepath
+
+	# If still no PID, raise exception
+	if pid == None:
+		raise Exception("No Pid available")
+
+	# Add list of files to upload specified as cmd args.
+	create_uploadables(server_dir, files, files_to_upload, anudc.get_file_scanner(), control)
+
+	return pid, files_to_upload
+
+
 class CommandLineManager():
-	def __init__(self, anudc=None, cmd_params=None):
+	def __init__(self, anudc=None, cmd_params=None, control=None, checkpoint=None):
 		self.__anudc = anudc
 		self.__cmd_params = cmd_params
+		self.__control = control
+		self.__checkpoint = checkpoint
 		
 	def process(self):
-		pid = None
-		files_to_upload = {}
+		if self.__cmd_params.download_dir != None:
+			self.__download()
+			return
+		
+		files_to_upload, file_status = create_upload_containers(self.__cmd_params.spool_dir, not self.__cmd_params.verify)
+		try:
+			pid, files_to_upload = plan_upload(self.__anudc, self.__cmd_params.metadata_file, self.__cmd_params.pid, self.__cmd_params.files, files_to_upload=files_to_upload, create=not self.__cmd_params.verify)
+		
+			if self.__cmd_params.verify:
+				with stop_on_signals(self.__control):
+					result = self.__anudc.verify_files(pid, files_to_upload, control=self.__control)
+				display_verify_summary(pid, result)
+			# If there are any files to upload, upload them.
+			elif len(files_to_upload) > 0:
+				with stop_on_signals(self.__control):
+					self.__anudc.upload_files(pid, files_to_upload, file_status, control=self.__control, checkpoint=self.__checkpoint)
+				display_summary(pid, file_status)
+		finally:
+			close_upload_containers(files_to_upload, file_status)
 	
-		# If a metadata file has been provided as command line arg, then create the record from the data. If
-		# it doesn't exist and read files to upload from it.
+		print()
+
+
+	def __download(self):
+		pid = self.__cmd_params.pid
 		if self.__cmd_params.metadata_file != None:
-			if not check_file_exists(self.__cmd_params.metadata_file):
-				raise Exception("Metadata file " + self.__cmd_params.metadata_file + " doesn't exist.")
-	
-			metadatafile = MetadataFile(self.__cmd_params.metadata_file)
-	
-			# Create record if PID doesn't already exist in the metadata file. Else, read the PID to upload files to it.
-			if metadatafile.read_pid() == None:
-				pid = self.__anudc.create_record(metadatafile)
-				metadatafile.write_pid(pid)
-	
-				# Create relations
-				self.__anudc.create_relations(pid, metadatafile.read_relations())
-			else:
-				pid = metadatafile.read_pid()
-	
-			# Add list of files to upload if any in the metadata file.
-			metadata_file_list = metadatafile.read_upload_files_list()
-			if metadata_file_list != None:
-				for target_rel_path, uploadable in metadata_file_list:
-					local_filepaths = list_files_in_dir(uploadable)
-					for local_filepath in local_filepaths:
-						if os.path.isfile(uploadable):
-							files_to_upload[target_rel_path] = local_filepath
-						elif os.path.isdir(uploadable):
-							relpath = target_rel_path
-							if relpath[-1:] != "/":
-								relpath += "/"
-							relpath += normalise_path_separators(os.path.relpath(local_filepath, os.path.dirname(uploadable)))
-							files_to_upload[relpath] = local_filepath
-	
-	
-		# If a new record wasn't created and the PID wasn't found in metadata file, check if it's provided as a cmd arg.
-		if pid == None and self.__cmd_params.pid != None:
-			pid = self.__cmd_params.pid
-	
-		# If still no PID, raise exception
+			metadata_pid = MetadataFile(self.__cmd_params.metadata_file).read_pid()
+			if metadata_pid != None:
+				pid = metadata_pid
 		if pid == None:
 			raise Exception("No Pid available")
+		
+		with stop_on_signals(self.__control):
+			file_status = self.__anudc.download_files(pid, self.__cmd_params.download_dir, self.__cmd_params.include_patterns, control=self.__control)
+		display_summary(pid, file_status, "DOWNLOAD SUMMARY")
+		print()
+
+
+class BatchManager():
+	'''Runs all jobs in a job file in a single process. Jobs share the AnudcClient and hence its connections, checksum
+	cache and upload workers. The number of jobs processed at a time is limited to the number of upload workers.
+	'''
+	def __init__(self, anudc=None, cmd_params=None, max_workers=1, control=None, checkpoint=None):
+		self.__anudc = anudc
+		self.__cmd_params = cmd_params
+		self.__max_workers = max_workers
+		self.__control = control
+		self.__checkpoint = checkpoint
 	
-		# Add list of files to upload specified as cmd args.
-		files_to_upload.update(create_uploadables("/", self.__cmd_params.files))
-	# 	if cmd_params.files != None:
-	# 		for file_param in cmd_params.files:
-	# 			local_filepaths = list_files_in_dir(file_param)
-	# 			for local_filepath in local_filepaths:
-	# 				if os.path.isfile(file_param):
-	# 					files_to_upload["/" + os.path.basename(local_filepath)] = local_filepath
-	# 				elif os.path.isdir(file_param):
-	# 					relpath = os.path.relpath(local_filepath, os.path.dirname(file_param))
-	# 					files_to_upload["/" + relpath.replace("\\", "/")] = local_filepath
-	
-	
-		# If there are any files to upload, upload them.
-		if len(files_to_upload) > 0:
-			file_status = self.__anudc.upload_files(pid, files_to_upload)
-			display_summary(pid, file_status)
+	def __run_job(self, job):
+		if self.__control is not None and self.__control.is_stopped():
+			raise Exception("Stopped before the job was started.")
+		
+		files_to_upload, file_status = create_upload_containers(self.__cmd_params.spool_dir, not self.__cmd_params.verify)
+		try:
+			pid, files_to_upload = plan_upload(self.__anudc, job.metadata_file, job.pid, job.files, job.server_dir, files_to_upload, create=not self.__cmd_params.verify, control=self.__control)
+			if self.__cmd_params.verify:
+				file_status = self.__anudc.verify_files(pid, files_to_upload, control=self.__control)
+			elif len(files_to_upload) > 0:
+				self.__anudc.upload_files(pid, files_to_upload, file_status, control=self.__control, checkpoint=self.__checkpoint)
+		except:
+			close_upload_containers(None, file_status)
+			raise
+		finally:
+			close_upload_containers(files_to_upload, None)
+		return pid, file_status
 	
+	def process(self):
+		jobs = JobFile(self.__cmd_params.job_file).read_jobs()
+		print("Processing " + str(len(jobs)) + " job(s) from " + self.__cmd_params.job_file)
+		
+		results = []
+		# Jobs list files while other jobs upload, so listing files is stopped through the UploadControl as well.
+		with stop_on_signals(self.__control), concurrent.futures.ThreadPoolExecutor(max_workers=self.__max_workers) as executor:
+			futures = [executor.submit(self.__run_job, job) for job in jobs]
+			for job, future in zip(jobs, futures):
+				try:
+					results.append((job, future.result(), None))
+				except Exception as e:
+					results.append((job, None, e))
+		
+		failed_jobs = 0
+		for job, result, error in results:
+			if error is None:
+				pid, file_status = result
+				if self.__cmd_params.verify:
+					display_verify_summary(pid, file_status)
+				else:
+					display_summary(pid, file_status)
+					close_upload_containers(None, file_status)
+			else:
+				failed_jobs += 1
+				print()
+				print("JOB FAILED - " + job.name + ": " + str(error))
+		
+		print()
+		print("{} job(s) completed. {} failed.".format(str(len(jobs) - failed_jobs), str(failed_jobs)))
 		print()
 
 	
@@ -238,6 +545,9 @@ class UploadWindow(tkinter.Frame):
 		self.__anudc = anudc
 		self.__local_filepaths = set()
 		self.__cmd_params = cmd_params
+		self.__events = queue.Queue()
+		self.__upload_control = None
+		self.__active_files = {}
 		
 		tkinter.Frame.__init__(self, master, width=500, height=500)
 		self.grid(sticky="WE")
@@ -260,20 +570,32 @@ class UploadWindow(tkinter.Frame):
 		label_upload_item = tkinter.Label(self, text="Upload:")
 		label_upload_item.grid(row=2, column=0, columnspan=1, sticky=tkinter.W)
 
-		button_add_files = tkinter.Button(self, text="Add Files...", command=self.__button_add_files_click)
-		button_add_files.grid(row=2, column=1, columnspan=1)
+		self.__button_add_files = tkinter.Button(self, text="Add Files...", command=self.__button_add_files_click)
+		self.__button_add_files.grid(row=2, column=1, columnspan=1)
 
-		button_add_dir = tkinter.Button(self, text="Add Folder...", command=self.__button_add_folder_click)
-		button_add_dir.grid(row=2, column=2, columnspan=1)
+		self.__button_add_dir = tkinter.Button(self, text="Add Folder...", command=self.__button_add_folder_click)
+		self.__button_add_dir.grid(row=2, column=2, columnspan=1)
 
 		self.__lb_uploadables = tkinter.Listbox(self, activestyle="none")
 		self.__lb_uploadables.grid(row=3, column=0, columnspan=3, sticky="WE")
 		
-		button_upload = tkinter.Button(self, text="Upload to Data Commons", underline=0, command=self.__button_upload_click)
-		button_upload.grid(row=4, column=1, columnspan=1)
+		self.__button_upload = tkinter.Button(self, text="Upload to Data Commons", underline=0, command=self.__button_upload_click)
+		self.__button_upload.grid(row=4, column=1, columnspan=1)
 		
-		button_reset = tkinter.Button(self, text="Reset", command=self.__button_reset_click)
-		button_reset.grid(row=4, column=2, columnspan=1)
+		self.__button_reset = tkinter.Button(self, text="Reset", command=self.__button_reset_click)
+		self.__button_reset.grid(row=4, column=2, columnspan=1)
+		
+		self.__button_pause = tkinter.Button(self, text="Pause", state=tkinter.DISABLED, command=self.__button_pause_click)
+		self.__button_pause.grid(row=5, column=1, columnspan=1)
+		
+		self.__button_cancel = tkinter.Button(self, text="Cancel", state=tkinter.DISABLED, command=self.__button_cancel_click)
+		self.__button_cancel.grid(row=5, column=2, columnspan=1)
+		
+		self.__lb_progress = tkinter.Listbox(self, activestyle="none", height=5)
+		self.__lb_progress.grid(row=6, column=0, columnspan=3, sticky="WE")
+		
+		self.__label_overall = tkinter.Label(self, text="")
+		self.__label_overall.grid(row=7, column=0, columnspan=3, sticky=tkinter.W)
 		
 		self.pack(fill=tkinter.BOTH, expand=tkinter.YES)
 
@@ -294,13 +616,109 @@ class UploadWindow(tkinter.Frame):
 
 	def __button_upload_click(self):
 		if len(self.__local_filepaths) > 0:
-			uploadables = create_uploadables(self.__entry_server_dir.get(), self.__local_filepaths)
-			file_status = self.__anudc.upload_files(self.__entry_pid.get(), uploadables)
-			display_summary(self.__entry_pid.get(), file_status)
-			self.__button_reset_click()
+			self.__upload_control = UploadControl()
+			self.__active_files = {}
+			self.__bytes_completed = 0
+			self.__files_completed = 0
+			self.__start_time = time.time()
+			self.__set_uploading(True)
+			
+			# Uploads run in a background thread so the window stays responsive. The thread reports progress through
+			# a queue which is polled from the Tk main loop, as Tk widgets must only be accessed from the main thread.
+			upload_thread = threading.Thread(target=self.__upload, args=(self.__entry_pid.get(), self.__entry_server_dir.get(), list(self.__local_filepaths), self.__upload_control), daemon=True)
+			upload_thread.start()
+			self.after(PROGRESS_POLL_INTERVAL_MS, self.__poll_events)
 		else:
 			tkinter.messagebox.showerror("No files selected", "You must select some files/folders to upload first.")
 
+	def __upload(self, pid, server_dir, local_filepaths, control):
+		spool_dir = None
+		if self.__cmd_params is not None:
+			spool_dir = self.__cmd_params.spool_dir
+		uploadables, file_status = create_upload_containers(spool_dir)
+		try:
+			create_uploadables(server_dir, local_filepaths, uploadables, self.__anudc.get_file_scanner(), control)
+			self.__anudc.upload_files(pid, uploadables, file_status, listener=self.__queue_event, control=control)
+			display_summary(pid, file_status)
+			self.__events.put((EVENT_UPLOAD_FINISHED, pid, (len(file_status), sum(1 for local_filepath, status in file_status.items() if status == 1))))
+		except Exception as e:
+			self.__events.put((EVENT_UPLOAD_FAILED, pid, e))
+		finally:
+			close_upload_containers(uploadables, file_status)
+
+	def __queue_event(self, event, local_filepath, value):
+		self.__events.put((event, local_filepath, value))
+
+	def __poll_events(self):
+		upload_ended = False
+		try:
+			while True:
+				event, local_filepath, value = self.__events.get_nowait()
+				if event == EVENT_FILE_STARTED:
+					self.__active_files[local_filepath] = [value, 0, time.time()]
+				elif event == EVENT_FILE_PROGRESS:
+					if local_filepath in self.__active_files:
+						self.__active_files[local_filepath][1] = value
+				elif event == EVENT_FILE_FINISHED:
+					if local_filepath in self.__active_files:
+						self.__bytes_completed += self.__active_files.pop(local_filepath)[1]
+					self.__files_completed += 1
+				elif event == EVENT_UPLOAD_FINISHED:
+					upload_ended = True
+					n_files, success_count = value
+					tkinter.messagebox.showinfo("Upload complete", "{} successful. {} failed.".format(str(success_count), str(n_files - success_count)))
+				elif event == EVENT_UPLOAD_FAILED:
+					upload_ended = True
+					tkinter.messagebox.showerror("Upload failed", str(value))
+		except queue.Empty:
+			pass
+		
+		self.__refresh_progress()
+		if upload_ended:
+			self.__set_uploading(False)
+			self.__button_reset_click()
+		else:
+			self.after(PROGRESS_POLL_INTERVAL_MS, self.__poll_events)
+
+	def __refresh_progress(self):
+		now = time.time()
+		self.__lb_progress.delete(0, tkinter.END)
+		bytes_in_progress = 0
+		for local_filepath, (size, bytes_sent, start_time) in self.__active_files.items():
+			bytes_in_progress += bytes_sent
+			percent = 100
+			if size > 0:
+				percent = int(bytes_sent * 100 / size)
+			self.__lb_progress.insert(tkinter.END, "{}%  [{:,.1f} KB/s]  {}".format(str(percent), kbps(bytes_sent, now - start_time), local_filepath))
+		
+		status = "Paused. " if self.__upload_control.is_paused() else ""
+		if self.__upload_control.is_cancelled():
+			status = "Cancelling. "
+		self.__label_overall.configure(text="{}{} file(s) done. Overall: {:,.1f} KB/s".format(status, str(self.__files_completed), kbps(self.__bytes_completed + bytes_in_progress, now - self.__start_time)))
+
+	def __set_uploading(self, uploading):
+		idle_state = tkinter.DISABLED if uploading else tkinter.NORMAL
+		upload_state = tkinter.NORMAL if uploading else tkinter.DISABLED
+		for button in (self.__button_add_files, self.__button_add_dir, self.__button_upload, self.__button_reset):
+			button.configure(state=idle_state)
+		for button in (self.__button_pause, self.__button_cancel):
+			button.configure(state=upload_state)
+		self.__button_pause.configure(text="Pause")
+
+	def __button_pause_click(self):
+		if self.__upload_control.is_paused():
+			self.__upload_control.resume()
+			self.__button_pause.configure(text="Pause")
+		else:
+			# Files already being uploaded will finish, but no others will be started until resumed.
+			self.__upload_control.pause()
+			self.__button_pause.configure(text="Resume")
+
+	def __button_cancel_click(self):
+		self.__upload_control.cancel()
+		self.__button_pause.configure(state=tkinter.DISABLED)
+		self.__button_cancel.configure(state=tkinter.DISABLED)
+
 	def __button_reset_click(self):
 		self.__local_filepaths.clear()
 		self.__refresh_lb_uploadables()
@@ -0,0 +1,209 @@
+'''
+Australian National University Data Commons
+Copyright (C) 2013  The Australian National University
+
+This file is part of Australian National University Data Commons.
+
+Australian National University Data Commons is free software: you
+can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Rahul Khanna <rahul.khanna@anu.edu.au>
+'''
+
+import linecache
+import os
+import sys
+import threading
+import time
+
+
+VERSION = "0.1-20261019"
+
+SAMPLE_INTERVAL_SEC = 0.005
+
+CATEGORY_CPU = "cpu"
+CATEGORY_GIL = "gil"
+CATEGORY_IO = "io"
+CATEGORY_SLEEP = "sleep"
+CATEGORY_WAIT = "wait"
+CATEGORIES = (CATEGORY_CPU, CATEGORY_GIL, CATEGORY_IO, CATEGORY_SLEEP, CATEGORY_WAIT)
+
+# Modules whose code is blocked on the network or disk when sampled.
+IO_MODULES = ("socket.py", "ssl.py", "client.py", "selectors.py", "socketserver.py")
+# Modules whose code is blocked waiting on other threads when sampled.
+WAIT_MODULES = ("threading.py", "queue.py", "_base.py", "thread.py")
+IO_CALLS = (".read(", ".readline(", ".write(", ".recv", ".send", ".request(", ".getresponse(", ".connect(", ".accept(", "os.walk(", "os.stat(", "os.path.")
+
+
+class SamplingProfiler:
+	'''Low overhead profiler that samples the stacks of all threads at regular intervals from a background thread. Each
+	sample is classified by what the innermost Python frame is doing: running Python code (cpu), blocked on the network
+	or disk (io), in time.sleep (sleep), or waiting for other threads (wait). As C functions don't have frames, the
+	classification is based on the module and source line of the innermost Python frame.
+	
+	A thread that is ready to run Python code may be waiting for the interpreter lock (GIL) held by another thread. Where
+	per thread CPU clocks are available, the CPU time each thread used since the previous sample splits the time of its
+	cpu samples into time running (cpu) and time waiting to run (gil).
+	'''
+	
+	def __init__(self, interval=SAMPLE_INTERVAL_SEC):
+		self.__interval = interval
+		# Sample weights for each stack and category. A weight of 1 is one thread for one sample.
+		self.__stack_counts = {}
+		self.__sample_count = 0
+		self.__thread_cpu_available = hasattr(time, "pthread_getcpuclockid")
+		self.__stopped = threading.Event()
+		self.__thread = None
+		self.__start_wall = None
+		self.__start_cpu = None
+		self.__wall_sec = 0
+		self.__cpu_sec = 0
+	
+	
+	def start(self):
+		self.__start_wall = time.perf_counter()
+		self.__start_cpu = time.process_time()
+		self.__thread = threading.Thread(target=self.__sample_loop, name="SamplingProfiler", daemon=True)
+		self.__thread.start()
+	
+	
+	def stop(self):
+		self.__stopped.set()
+		self.__thread.join()
+		self.__wall_sec = time.perf_counter() - self.__start_wall
+		self.__cpu_sec = time.process_time() - self.__start_cpu
+	
+	
+	def __sample_loop(self):
+		own_thread_id = threading.get_ident()
+		# CPU time of each thread at the previous sample.
+		thread_cpu_secs = {}
+		sample_time = time.perf_counter()
+		while not self.__stopped.wait(self.__interval):
+			previous_sample_time = sample_time
+			sample_time = time.perf_counter()
+			previous_thread_cpu_secs = thread_cpu_secs
+			thread_cpu_secs = {}
+			thread_names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+			for thread_id, frame in sys._current_frames().items():
+				if thread_id == own_thread_id:
+					continue
+				thread_cpu_secs[thread_id] = self.__get_thread_cpu_sec(thread_id)
+				category = self.__classify(frame)
+				stack = []
+				while frame is not None:
+					stack.append(os.path.basename(frame.f_code.co_filename) + ":" + frame.f_code.co_name)
+					frame = frame.f_back
+				stack.append(thread_names.get(thread_id, str(thread_id)))
+				stack.reverse()
+				stack = tuple(stack)
+				
+				running = 1
+				if category == CATEGORY_CPU and thread_cpu_secs[thread_id] is not None and previous_thread_cpu_secs.get(thread_id) is not None:
+					running = (thread_cpu_secs[thread_id] - previous_thread_cpu_secs[thread_id]) / (sample_time - previous_sample_time)
+					running = min(max(running, 0), 1)
+					self.__add_sample(stack, CATEGORY_GIL, 1 - running)
+				self.__add_sample(stack, category, running)
+			self.__sample_count += 1
+	
+	
+	def __add_sample(self, stack, category, weight):
+		if weight > 0:
+			key = (stack, category)
+			self.__stack_counts[key] = self.__stack_counts.get(key, 0) + weight
+	
+	
+	def __get_thread_cpu_sec(self, thread_id):
+		'''Returns the CPU time used by a thread, or None if it isn't available on this platform or the thread has exited.
+		'''
+		if not self.__thread_cpu_available:
+			return None
+		try:
+			return time.clock_gettime(time.pthread_getcpuclockid(thread_id))
+		except OSError:
+			return None
+	
+	
+	def __classify(self, frame):
+		module = os.path.basename(frame.f_code.co_filename)
+		line = linecache.getline(frame.f_code.co_filename, frame.f_lineno)
+		if "sleep(" in line:
+			return CATEGORY_SLEEP
+		if module in WAIT_MODULES:
+			return CATEGORY_WAIT
+		if module in IO_MODULES or any(call in line for call in IO_CALLS):
+			return CATEGORY_IO
+		return CATEGORY_CPU
+	
+	
+	def write_folded(self, filename):
+		'''Writes samples in the folded stack format read by flamegraph.pl and speedscope: one line per distinct stack of
+		semicolon separated frames, outermost first, followed by the time spent in it in milliseconds. The category of
+		each sample is added as the innermost frame.
+		'''
+		with open(filename, "w", encoding="utf-8") as fp:
+			for (stack, category), count in sorted(self.__stack_counts.items()):
+				msec = round(count * self.__get_sample_sec() * 1000)
+				if msec > 0:
+					fp.write(";".join(stack) + ";[" + category + "] " + str(msec) + "\n")
+	
+	
+	def print_summary(self, top_n=20):
+		self_counts = {}
+		total_counts = {}
+		for (stack, category), count in self.__stack_counts.items():
+			function = stack[-1]
+			counts = self_counts.setdefault(function, dict((c, 0) for c in CATEGORIES))
+			counts[category] += count
+			# Count each function once per stack even if it's recursive.
+			for function in set(stack[1:]):
+				total_counts[function] = total_counts.get(function, 0) + count
+		
+		cpu_percent = 0
+		if self.__wall_sec > 0:
+			cpu_percent = self.__cpu_sec * 100 / self.__wall_sec
+		print()
+		print("PROFILE SUMMARY")
+		print("---------------------------")
+		print("Wall time {:,.1f} sec, process CPU time {:,.1f} sec ({:.0f}%), {} samples every {:.1f} ms".format(self.__wall_sec, self.__cpu_sec, cpu_percent, str(self.__sample_count), self.__get_sample_sec() * 1000))
+		print()
+		
+		# Time threads spend idle waiting on other threads isn't useful when looking for hot spots, so it's shown but not
+		# used for ranking.
+		def busy_samples(item):
+			counts = item[1]
+			return counts[CATEGORY_CPU] + counts[CATEGORY_GIL] + counts[CATEGORY_IO] + counts[CATEGORY_SLEEP]
+		
+		print("{:>8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}  {}".format("self", "cpu", "gil", "io", "sleep", "wait", "total", "function"))
+		for function, counts in sorted(self_counts.items(), key=busy_samples, reverse=True)[:top_n]:
+			print("{:>8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}  {}".format(
+				self.__format_sec(sum(counts.values())), self.__format_sec(counts[CATEGORY_CPU]), self.__format_sec(counts[CATEGORY_GIL]),
+				self.__format_sec(counts[CATEGORY_IO]), self.__format_sec(counts[CATEGORY_SLEEP]), self.__format_sec(counts[CATEGORY_WAIT]),
+				self.__format_sec(total_counts.get(function, 0)), function))
+		print("Times are in seconds, summed across threads.")
+		if not self.__thread_cpu_available:
+			print("Per thread CPU time isn't available on this platform, so time waiting for the GIL is included in cpu.")
+	
+	
+	def __get_sample_sec(self):
+		'''Returns the wall time each sample stands for. Samples are taken less often than requested when the sampling
+		thread is kept waiting for the GIL, so this is measured rather than assumed to be the requested interval.
+		'''
+		if self.__sample_count == 0:
+			return self.__interval
+		return self.__wall_sec / self.__sample_count
+	
+	
+	def __format_sec(self, sample_count):
+		return "{:,.2f}".format(sample_count * self.__get_sample_sec())
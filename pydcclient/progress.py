@@ -30,10 +30,23 @@ VERSION = "0.1-20140318"
 
 
 class ProgressFile:
-	def __init__(self, filename, mode):
-		self.__f = open(filename, mode)
-		self.__total = os.fstat(self.__f.fileno()).st_size
-		self.__f.seek(0)
+	def __init__(self, filename, mode, display=True, callback=None, start=0, length=None):
+		# filename may also be a file already opened in binary mode, which is closed along with the ProgressFile.
+		if hasattr(filename, "read"):
+			self.__f = filename
+		else:
+			self.__f = open(filename, mode)
+		self.__display = display
+		# Called with the number of bytes read so far after each read.
+		self.__callback = callback
+		# If length is provided, only length bytes from start are read.
+		self.__start = start
+		self.__length = length
+		if length is None:
+			self.__total = os.fstat(self.__f.fileno()).st_size - start
+		else:
+			self.__total = length
+		self.__f.seek(start)
 		self.__percent_complete = 0
 		self.__status_text_len = 0
 		self.__t0 = None
@@ -62,10 +75,14 @@ class ProgressFile:
 	def read(self, size):
 		if self.__t0 is None:
 			self.__t0 = datetime.now()
+		if self.__length is not None:
+			size = min(size, self.__length - self.tell())
 		data = self.__f.read(size)
 		# If the output is going to a log file, don't display progress.
-		if sys.stdout.isatty():
+		if self.__display and sys.stdout.isatty():
 			self.__disp_progress()
+		if self.__callback is not None:
+			self.__callback(self.tell())
 			
 		return data
 
@@ -73,11 +90,12 @@ class ProgressFile:
 		return self.__f.fileno()
 
 	def tell(self):
-		return self.__f.tell() 
+		return self.__f.tell() - self.__start
 				
 	def close(self):
 		self.__f.close()
-		print()
+		if self.__display:
+			print()
 		
 	def __exit__(self):
 		self.__f.close()
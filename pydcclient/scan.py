@@ -0,0 +1,164 @@
+'''
+Australian National University Data Commons
+Copyright (C) 2013  The Australian National University
+
+This file is part of Australian National University Data Commons.
+
+Australian National University Data Commons is free software: you
+can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Rahul Khanna <rahul.khanna@anu.edu.au>
+'''
+
+import collections
+import concurrent.futures
+import logging
+import os
+import stat
+import threading
+
+
+VERSION = "0.1-20261019"
+
+# Number of directories read at a time. Directory reads on network filesystems are mostly spent waiting on the server,
+# so more workers than CPUs helps.
+SCAN_WORKERS = 8
+
+# Number of stats kept by a StatCache. The oldest entries are dropped first, so memory stays bounded however many files
+# are scanned. Trees larger than this are stat-ed again as they're uploaded.
+STAT_CACHE_SIZE = 4096
+
+
+class StatCache:
+	'''Caches os.stat results of local files while files are planned and uploaded, so each file is only stat-ed once on
+	filesystems where every stat is a round trip to a server. Entries are added when directories are scanned or on the
+	first stat of a file, and kept until cleared, which AnudcClient does after each upload, or until max_entries newer
+	entries have been added. Failed stats are not cached.
+	'''
+	def __init__(self, max_entries=STAT_CACHE_SIZE):
+		self.__entries = collections.OrderedDict()
+		self.__max_entries = max_entries
+		self.__lock = threading.Lock()
+	
+	def stat(self, path):
+		key = os.path.abspath(path)
+		with self.__lock:
+			stat_result = self.__entries.get(key)
+		if stat_result is None:
+			stat_result = os.stat(path)
+			self.__put(key, stat_result)
+		return stat_result
+	
+	def put(self, path, stat_result):
+		self.__put(os.path.abspath(path), stat_result)
+	
+	def __put(self, key, stat_result):
+		with self.__lock:
+			self.__entries[key] = stat_result
+			self.__entries.move_to_end(key)
+			while len(self.__entries) > self.__max_entries:
+				self.__entries.popitem(last=False)
+	
+	def invalidate(self, path):
+		with self.__lock:
+			self.__entries.pop(os.path.abspath(path), None)
+	
+	def clear(self):
+		with self.__lock:
+			self.__entries.clear()
+	
+	def isfile(self, path):
+		try:
+			return stat.S_ISREG(self.stat(path).st_mode)
+		except OSError:
+			return False
+	
+	def isdir(self, path):
+		try:
+			return stat.S_ISDIR(self.stat(path).st_mode)
+		except OSError:
+			return False
+	
+	def getsize(self, path):
+		return self.stat(path).st_size
+
+
+class FileScanner:
+	'''Lists the files in directory trees, reading several directories at a time with os.scandir. The stat of each file
+	found is added to the stat cache. Files and directories whose names start with '.' are skipped, and symbolic links to
+	directories aren't followed.
+	'''
+	def __init__(self, stat_cache=None, max_workers=SCAN_WORKERS):
+		if stat_cache is None:
+			stat_cache = StatCache()
+		self.__stat_cache = stat_cache
+		self.__max_workers = max(1, max_workers)
+	
+	def get_stat_cache(self):
+		return self.__stat_cache
+	
+	def walk(self, dirpath):
+		'''Yields the paths of files in dirpath and all its subdirectories as each directory is read. Files are yielded in
+		no particular order.
+		'''
+		pending_dirs = collections.deque([dirpath])
+		if self.__max_workers == 1:
+			while len(pending_dirs) > 0:
+				files, subdirs = self.__scan_dir(pending_dirs.popleft())
+				pending_dirs.extend(subdirs)
+				yield from files
+			return
+		
+		with concurrent.futures.ThreadPoolExecutor(max_workers=self.__max_workers) as executor:
+			# Directories waiting to be read are kept in pending_dirs rather than submitted straight away so the
+			# executor's queue doesn't grow with the size of the tree.
+			in_flight = set()
+			try:
+				while len(pending_dirs) > 0 or len(in_flight) > 0:
+					while len(pending_dirs) > 0 and len(in_flight) < self.__max_workers * 2:
+						in_flight.add(executor.submit(self.__scan_dir, pending_dirs.popleft()))
+					done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+					for future in done:
+						files, subdirs = future.result()
+						pending_dirs.extend(subdirs)
+						yield from files
+			finally:
+				for future in in_flight:
+					future.cancel()
+	
+	def __scan_dir(self, dirpath):
+		files = []
+		subdirs = []
+		try:
+			with os.scandir(dirpath) as entries:
+				for entry in entries:
+					if entry.name[0] == ".":
+						continue
+					try:
+						is_dir = entry.is_dir()
+					except OSError:
+						is_dir = False
+					if is_dir:
+						if not entry.is_symlink():
+							subdirs.append(entry.path)
+					else:
+						try:
+							self.__stat_cache.put(entry.path, entry.stat())
+						except OSError:
+							# Broken links are listed like os.walk does, and fail when they're uploaded.
+							pass
+						files.append(entry.path)
+		except OSError as e:
+			logging.warning("Unable to read directory " + dirpath + ": " + str(e))
+		return files, subdirs
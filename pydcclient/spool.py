@@ -0,0 +1,247 @@
+'''
+Australian National University Data Commons
+Copyright (C) 2013  The Australian National University
+
+This file is part of Australian National University Data Commons.
+
+Australian National University Data Commons is free software: you
+can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Rahul Khanna <rahul.khanna@anu.edu.au>
+'''
+
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+
+
+VERSION = "0.1-20261019"
+
+BATCH_SIZE = 1000
+
+
+class UploadQueue:
+	'''Disk backed replacement for the dict of files to upload, keyed on target path. Supports the subset of the dict
+	interface used when planning and uploading files, while only holding BATCH_SIZE entries in memory at a time.
+	'''
+	__slots__ = ("__filename", "__db", "__lock")
+	
+	def __init__(self, spool_dir=None):
+		fd, self.__filename = tempfile.mkstemp(prefix="upload-queue-", suffix=".db", dir=spool_dir)
+		os.close(fd)
+		self.__db = sqlite3.connect(self.__filename, check_same_thread=False)
+		self.__db.execute("PRAGMA journal_mode=OFF")
+		self.__db.execute("PRAGMA synchronous=OFF")
+		self.__db.execute("CREATE TABLE uploadables (target_path TEXT PRIMARY KEY, local_filepath TEXT NOT NULL)")
+		self.__lock = threading.Lock()
+	
+	def __setitem__(self, target_path, local_filepath):
+		with self.__lock:
+			self.__db.execute("INSERT OR REPLACE INTO uploadables VALUES (?, ?)", (target_path, local_filepath))
+	
+	def __len__(self):
+		with self.__lock:
+			return self.__db.execute("SELECT COUNT(*) FROM uploadables").fetchone()[0]
+	
+	def update(self, uploadables):
+		with self.__lock:
+			self.__db.executemany("INSERT OR REPLACE INTO uploadables VALUES (?, ?)", uploadables.items())
+	
+	def items(self):
+		last_rowid = 0
+		while True:
+			with self.__lock:
+				rows = self.__db.execute("SELECT rowid, target_path, local_filepath FROM uploadables WHERE rowid > ? ORDER BY rowid LIMIT ?", (last_rowid, BATCH_SIZE)).fetchall()
+			if len(rows) == 0:
+				return
+			for rowid, target_path, local_filepath in rows:
+				yield target_path, local_filepath
+			last_rowid = rows[-1][0]
+	
+	def close(self):
+		with self.__lock:
+			self.__db.close()
+		os.remove(self.__filename)
+
+
+class SpoolDict:
+	'''Disk backed replacement for a dict with string keys, for caches that would otherwise hold an entry for every file.
+	Values may be True or tuples of strings and integers. Supports the subset of the dict interface used by the caches,
+	while only holding BATCH_SIZE entries in memory at a time when iterating.
+	'''
+	__slots__ = ("__filename", "__db", "__lock")
+	
+	def __init__(self, spool_dir=None):
+		fd, self.__filename = tempfile.mkstemp(prefix="spool-dict-", suffix=".db", dir=spool_dir)
+		os.close(fd)
+		self.__db = sqlite3.connect(self.__filename, check_same_thread=False)
+		self.__db.execute("PRAGMA journal_mode=OFF")
+		self.__db.execute("PRAGMA synchronous=OFF")
+		self.__db.execute("CREATE TABLE entries (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+		self.__lock = threading.Lock()
+	
+	def __decode(self, value):
+		value = json.loads(value)
+		if isinstance(value, list):
+			value = tuple(value)
+		return value
+	
+	def __setitem__(self, key, value):
+		with self.__lock:
+			self.__db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?)", (key, json.dumps(value)))
+	
+	def __getitem__(self, key):
+		value = self.get(key)
+		if value is None:
+			raise KeyError(key)
+		return value
+	
+	def __contains__(self, key):
+		with self.__lock:
+			return self.__db.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone() is not None
+	
+	def __len__(self):
+		with self.__lock:
+			return self.__db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+	
+	def __iter__(self):
+		for key, value in self.items():
+			yield key
+	
+	def get(self, key, default=None):
+		with self.__lock:
+			row = self.__db.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+		if row is None:
+			return default
+		return self.__decode(row[0])
+	
+	def update(self, items):
+		if isinstance(items, dict):
+			items = items.items()
+		with self.__lock:
+			self.__db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?)", ((key, json.dumps(value)) for key, value in items))
+	
+	def items(self):
+		last_rowid = 0
+		while True:
+			with self.__lock:
+				rows = self.__db.execute("SELECT rowid, key, value FROM entries WHERE rowid > ? ORDER BY rowid LIMIT ?", (last_rowid, BATCH_SIZE)).fetchall()
+			if len(rows) == 0:
+				return
+			for rowid, key, value in rows:
+				yield key, self.__decode(value)
+			last_rowid = rows[-1][0]
+	
+	def clear(self):
+		with self.__lock:
+			self.__db.execute("DELETE FROM entries")
+	
+	def close(self):
+		with self.__lock:
+			self.__db.close()
+		os.remove(self.__filename)
+
+
+class UploadStatusLog:
+	'''Disk backed replacement for the dict of file upload statuses. Each status is appended to a results file as soon as
+	it's set and only the success and failure counts are held in memory.
+	'''
+	__slots__ = ("__filename", "__fp", "__success_count", "__failed_count", "__lock")
+	
+	def __init__(self, spool_dir=None):
+		fd, self.__filename = tempfile.mkstemp(prefix="upload-status-", suffix=".txt", dir=spool_dir)
+		self.__fp = os.fdopen(fd, "w", encoding="utf-8")
+		self.__success_count = 0
+		self.__failed_count = 0
+		self.__lock = threading.Lock()
+	
+	def __setitem__(self, local_filepath, status):
+		with self.__lock:
+			self.__fp.write(str(status) + "\t" + local_filepath + "\n")
+			if status == 1:
+				self.__success_count += 1
+			else:
+				self.__failed_count += 1
+	
+	def __len__(self):
+		return self.__success_count + self.__failed_count
+	
+	def get_filename(self):
+		return self.__filename
+	
+	def get_success_count(self):
+		return self.__success_count
+	
+	def get_failed_count(self):
+		return self.__failed_count
+	
+	def items(self):
+		with self.__lock:
+			self.__fp.flush()
+		with open(self.__filename, "r", encoding="utf-8") as fp:
+			for line in fp:
+				status, local_filepath = line.rstrip("\n").split("\t", 1)
+				yield local_filepath, int(status)
+	
+	def close(self):
+		with self.__lock:
+			self.__fp.close()
+
+
+class UploadCheckpoint:
+	'''Records files that have been uploaded so that a run that was interrupted can be restarted without checking them
+	again. Each uploaded file is appended to the checkpoint file as soon as its upload completes, and is only treated as
+	uploaded if its size and modification time haven't changed since. stat is called to get the size and modification time
+	of files. If a spool directory is provided, the entries are kept on disk in that directory instead of in memory.
+	'''
+	__slots__ = ("__filename", "__stat", "__entries", "__fp", "__lock")
+	
+	def __init__(self, filename, stat=os.stat, spool_dir=None):
+		self.__filename = filename
+		self.__stat = stat
+		# Entries are keyed on their line in the checkpoint file.
+		self.__entries = {} if spool_dir is None else SpoolDict(spool_dir)
+		self.__lock = threading.Lock()
+		if os.path.isfile(self.__filename):
+			with open(self.__filename, "r", encoding="utf-8") as fp:
+				# Format: pid<TAB>size<TAB>mtime_ns<TAB>target_path<TAB>local_filepath
+				self.__entries.update((line.rstrip("\n"), True) for line in fp if line.count("\t") >= 4)
+		self.__fp = open(self.__filename, "a", encoding="utf-8")
+	
+	def __entry(self, pid, target_path, local_filepath):
+		stat = self.__stat(local_filepath)
+		return "\t".join((pid, str(stat.st_size), str(stat.st_mtime_ns), target_path, local_filepath))
+	
+	def contains(self, pid, target_path, local_filepath):
+		# A file that can't be read, such as a broken symlink, is uploaded as usual so the error is reported for that file.
+		try:
+			entry = self.__entry(pid, target_path, local_filepath)
+		except OSError:
+			return False
+		return entry in self.__entries
+	
+	def add(self, pid, target_path, local_filepath):
+		entry = self.__entry(pid, target_path, local_filepath)
+		with self.__lock:
+			self.__entries[entry] = True
+			self.__fp.write(entry + "\n")
+			self.__fp.flush()
+	
+	def close(self):
+		with self.__lock:
+			self.__fp.close()
+			if isinstance(self.__entries, SpoolDict):
+				self.__entries.close()
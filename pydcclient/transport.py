@@ -0,0 +1,333 @@
+'''
+Australian National University Data Commons
+Copyright (C) 2013  The Australian National University
+
+This file is part of Australian National University Data Commons.
+
+Australian National University Data Commons is free software: you
+can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Rahul Khanna <rahul.khanna@anu.edu.au>
+'''
+
+import hashlib
+import http.client
+import random
+import threading
+import time
+import urllib.parse
+
+
+VERSION = "0.1-20261019"
+
+FAKE_BLOCK_SIZE = 65536
+
+
+class HttpTransport:
+	'''Creates connections to the Data Commons server using http.client.
+	
+	A transport is any object with a create_connection method. The connections it returns must have the methods of
+	http.client.HTTPConnection that AnudcClient uses: request(method, url, body, headers), where body may be a file object
+	that is read as it's sent, getresponse(), connect() and close(). Responses must have status, reason, getheader(name)
+	and read(amt=None). Connections are pooled by AnudcClient, whichever transport is used.
+	'''
+	def __init__(self, hostname, protocol):
+		self.__hostname = hostname
+		self.__protocol = protocol
+	
+	def create_connection(self):
+		if self.__protocol == "https":
+			return http.client.HTTPSConnection(self.__hostname)
+		else:
+			return http.client.HTTPConnection(self.__hostname)
+
+
+class FakeTransport:
+	'''Creates connections to a FakeServer in this process instead of the network.
+	'''
+	def __init__(self, server):
+		self.__server = server
+	
+	def __getstate__(self):
+		raise Exception("The fake server only exists in this process and can't be used by other processes.")
+	
+	def get_server(self):
+		return self.__server
+	
+	def create_connection(self):
+		return FakeConnection(self.__server)
+
+
+class FakeServer:
+	'''In-memory stand-in for the Data Commons server, for load testing the client without a network. Requests are routed
+	using the URLs in anudc.conf. Records can be created, relations added, and files uploaded, patched, checked, listed
+	and downloaded.
+	
+	latency is the time in seconds each request waits for its response. throughput is the rate in bytes per second of the
+	link shared by all connections, or 0 for no limit. failure_rate is the fraction of requests that fail, either by the
+	connection being reset or with a 503 response. Failures are chosen using a random number generator created with seed,
+	so a sequential run fails the same requests each time. If capacity is more than 0, it's the number of requests the
+	server handles at a time at full speed. Response times grow in proportion to the number of requests beyond that, and
+	requests beyond twice that get 503 responses.
+	'''
+	def __init__(self, anudc_config, latency=0, throughput=0, failure_rate=0, capacity=0, seed=None):
+		self.__create_url = urllib.parse.urlsplit(anudc_config.get_config_createurl(None)).path
+		self.__addlink_url = anudc_config.get_config_addlinkurl()
+		self.__uploadfile_url = anudc_config.get_config_uploadfileurl()
+		self.__listfiles_url = anudc_config.get_config_listfilesurl()
+		self.__patchfile_url = anudc_config.get_config_patchfileurl()
+		self.__latency = latency
+		self.__throughput = throughput
+		self.__failure_rate = failure_rate
+		self.__capacity = capacity
+		self.__active_requests = 0
+		self.__random = random.Random(seed)
+		self.__files = {}
+		self.__records = {}
+		self.__links = []
+		# Copies of files being patched, keyed on X-Patch-Id.
+		self.__patches = {}
+		self.__stats = {"requests": 0, "failures": 0, "overloads": 0, "connections": 0, "bytes_received": 0, "bytes_sent": 0}
+		# Time at which the simulated link is next free.
+		self.__link_free_at = 0
+		self.__lock = threading.Lock()
+	
+	def get_stats(self):
+		with self.__lock:
+			return dict(self.__stats)
+	
+	def get_file(self, pid, target_path):
+		with self.__lock:
+			return self.__files.get(self.__get_file_path(pid, target_path))
+	
+	def get_links(self, pid):
+		with self.__lock:
+			return [(link_type, related_pid) for link_pid, link_type, related_pid in self.__links if link_pid == pid]
+	
+	def connection_opened(self):
+		with self.__lock:
+			self.__stats["connections"] += 1
+	
+	def request_started(self):
+		with self.__lock:
+			self.__active_requests += 1
+	
+	def request_finished(self):
+		with self.__lock:
+			self.__active_requests -= 1
+	
+	def transfer(self, num_bytes, sent):
+		'''Waits for num_bytes to cross the simulated link.
+		'''
+		with self.__lock:
+			self.__stats["bytes_sent" if sent else "bytes_received"] += num_bytes
+			if self.__throughput <= 0:
+				return
+			now = time.monotonic()
+			start = max(now, self.__link_free_at)
+			self.__link_free_at = start + num_bytes / self.__throughput
+			delay = self.__link_free_at - now
+		time.sleep(delay)
+	
+	def handle(self, method, url, headers, body):
+		'''Returns the status, reason, headers and body of the response to a request. Raises ConnectionResetError if the
+		request is chosen to fail by resetting the connection.
+		'''
+		with self.__lock:
+			load = 1
+			if self.__capacity > 0:
+				load = max(1, self.__active_requests / self.__capacity)
+		if self.__latency > 0:
+			time.sleep(self.__latency * load)
+		with self.__lock:
+			self.__stats["requests"] += 1
+			if load > 2:
+				self.__stats["overloads"] += 1
+				return 503, "Service Unavailable", {}, b"Overloaded"
+			if self.__failure_rate > 0 and self.__random.random() < self.__failure_rate:
+				self.__stats["failures"] += 1
+				if self.__random.random() < 0.5:
+					raise ConnectionResetError("Connection reset by fake server")
+				return 503, "Service Unavailable", {}, b""
+			
+			path = urllib.parse.unquote(urllib.parse.urlsplit(url).path)
+			if method == "POST" and self.__patchfile_url is not None and path.startswith(self.__patchfile_url):
+				return self.__handle_patch(self.__uploadfile_url + path[len(self.__patchfile_url):], headers, body)
+			elif path.startswith(self.__uploadfile_url):
+				return self.__handle_file(method, path, headers, body)
+			elif method == "POST" and path == self.__create_url:
+				return self.__handle_create(headers)
+			elif method == "POST" and path.startswith(self.__addlink_url):
+				fields = urllib.parse.parse_qs(body.decode("utf-8"))
+				self.__links.append((path[len(self.__addlink_url):], fields["linkType"][0], fields["itemId"][0]))
+				return 200, "OK", {}, b"OK"
+			elif method == "GET" and self.__listfiles_url is not None and path.startswith(self.__listfiles_url):
+				prefix = self.__get_file_path(path[len(self.__listfiles_url):], "")
+				body = "\n".join(file_path[len(prefix):] for file_path in sorted(self.__files) if file_path.startswith(prefix))
+				return 200, "OK", {}, body.encode("utf-8")
+			return 404, "Not Found", {}, b""
+	
+	def __handle_create(self, headers):
+		# Records created with the same Idempotency-Key are only created once.
+		request_key = headers.get("Idempotency-Key")
+		if request_key is not None and request_key in self.__records:
+			return 200, "OK", {}, self.__records[request_key].encode("utf-8")
+		pid = "test:" + str(len(self.__records) + 1)
+		self.__records[request_key if request_key is not None else pid] = pid
+		return 201, "Created", {}, pid.encode("utf-8")
+	
+	def __handle_file(self, method, path, headers, body):
+		data = self.__files.get(path)
+		if method == "POST":
+			md5 = hashlib.md5(body).hexdigest()
+			if headers.get("Content-MD5") not in (None, md5):
+				return 400, "Bad Request", {}, b"MD5 mismatch"
+			self.__files[path] = body
+			return 201, "Created", {}, b"OK"
+		elif data is None:
+			return 404, "Not Found", {}, b""
+		
+		response_headers = {"Content-MD5": hashlib.md5(data).hexdigest(), "Content-Length": str(len(data))}
+		if method == "HEAD":
+			return 200, "OK", response_headers, b""
+		
+		byte_range = headers.get("Range")
+		if byte_range is None:
+			return 200, "OK", response_headers, data
+		start, end = byte_range.split("=", 1)[1].split("-", 1)
+		start = int(start)
+		end = int(end) if end != "" else len(data) - 1
+		if start >= len(data):
+			return 416, "Range Not Satisfiable", {}, b""
+		part = data[start:end + 1]
+		response_headers["Content-Range"] = "bytes {}-{}/{}".format(start, start + len(part) - 1, len(data))
+		response_headers["Content-Length"] = str(len(part))
+		return 206, "Partial Content", response_headers, part
+	
+	def __handle_patch(self, path, headers, body):
+		# The first request of a patch copies the file if it's the version the patch was made against. The copy is
+		# patched by each request and replaces the file once the last request's Content-MD5 matches.
+		patch_id = headers.get("X-Patch-Id")
+		if "If-Match" in headers:
+			data = self.__files.get(path)
+			if data is None:
+				return 404, "Not Found", {}, b""
+			if hashlib.md5(data).hexdigest() != headers["If-Match"]:
+				return 412, "Precondition Failed", {}, b"File has changed"
+			self.__patches[patch_id] = bytearray(data)
+		patched = self.__patches.get(patch_id)
+		if patched is None:
+			return 409, "Conflict", {}, b"Unknown patch"
+		
+		byte_range, total = headers["Content-Range"].split(" ", 1)[1].split("/", 1)
+		del patched[int(total):]
+		if byte_range != "*":
+			start = int(byte_range.split("-", 1)[0])
+			if start > len(patched):
+				patched.extend(bytes(start - len(patched)))
+			patched[start:start + len(body)] = body
+		
+		if "Content-MD5" not in headers:
+			return 202, "Accepted", {}, b""
+		del self.__patches[patch_id]
+		if hashlib.md5(patched).hexdigest() != headers["Content-MD5"]:
+			return 409, "Conflict", {}, b"MD5 mismatch"
+		self.__files[path] = bytes(patched)
+		return 200, "OK", {}, b"OK"
+	
+	def __get_file_path(self, pid, target_path):
+		return self.__uploadfile_url + pid + "/data" + target_path
+
+
+class FakeConnection:
+	def __init__(self, server):
+		self.__server = server
+		self.__connected = False
+		self.__request = None
+	
+	def connect(self):
+		if not self.__connected:
+			self.__server.connection_opened()
+			self.__connected = True
+	
+	def close(self):
+		self.__connected = False
+		if self.__request is not None:
+			self.__server.request_finished()
+			self.__request = None
+	
+	def request(self, method, url, body=None, headers=None):
+		if self.__request is not None:
+			raise http.client.CannotSendRequest()
+		self.connect()
+		self.__server.request_started()
+		try:
+			if body is None:
+				body = b""
+			elif isinstance(body, str):
+				body = body.encode("utf-8")
+				self.__server.transfer(len(body), False)
+			elif isinstance(body, bytes):
+				self.__server.transfer(len(body), False)
+			else:
+				# File objects are read a block at a time as they're sent, like http.client does.
+				blocks = []
+				block = body.read(FAKE_BLOCK_SIZE)
+				while len(block) > 0:
+					self.__server.transfer(len(block), False)
+					blocks.append(block)
+					block = body.read(FAKE_BLOCK_SIZE)
+				body = b"".join(blocks)
+		except BaseException:
+			self.__server.request_finished()
+			raise
+		self.__request = (method, url, dict(headers) if headers is not None else {}, body)
+	
+	def getresponse(self):
+		if self.__request is None:
+			raise http.client.ResponseNotReady()
+		method, url, headers, body = self.__request
+		self.__request = None
+		try:
+			status, reason, response_headers, response_body = self.__server.handle(method, url, headers, body)
+		except ConnectionResetError:
+			self.__connected = False
+			raise
+		finally:
+			self.__server.request_finished()
+		return FakeResponse(self.__server, status, reason, response_headers, response_body)
+
+
+class FakeResponse:
+	def __init__(self, server, status, reason, headers, body):
+		self.__server = server
+		self.status = status
+		self.reason = reason
+		self.__headers = dict((name.lower(), value) for name, value in headers.items())
+		self.__body = body
+		self.__offset = 0
+	
+	def getheader(self, name, default=None):
+		return self.__headers.get(name.lower(), default)
+	
+	def getheaders(self):
+		return list(self.__headers.items())
+	
+	def read(self, amt=None):
+		if amt is None:
+			amt = len(self.__body) - self.__offset
+		data = self.__body[self.__offset:self.__offset + amt]
+		self.__offset += len(data)
+		self.__server.transfer(len(data), True)
+		return data